@@ -0,0 +1,218 @@
+"""
+ASGI entry point
+
+Serves the same Flask app (every route of flaskr) on an ASGI server:
+
+    uvicorn asgi:app --workers 4
+
+The event loop holds the client connections (slow clients and keep-alive
+cost no thread) while the route code runs on a thread pool sized to the
+database connection pool, so a request never waits on a pool slot while
+holding a thread. A streamed body keeps its pool thread until it ends,
+except the room event streams, which are handed to the event loop (see
+AsgiApp) so any number of subscribers hold no thread. The database access
+itself stays synchronous: SQLAlchemy 1.3 and Flask-SQLAlchemy 2.4, as
+pinned in requirements.txt, have no asyncio driver support.
+"""
+
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from flaskr import create_app
+
+
+ASYNC_BODY = 'trivia.async_body'
+
+
+"""
+AsgiApp(wsgi_app, max_threads)
+    runs a WSGI application under ASGI, one pool thread per request.
+    Request bodies are read into memory before the app is called; response
+    bodies are streamed chunk by chunk. A route can instead leave an async
+    iterator of str chunks in environ[ASYNC_BODY]: its headers are sent,
+    the pool thread is released and the event loop streams the iterator
+    (the WSGI body is dropped).
+"""
+class AsgiApp:
+
+    def __init__(self, wsgi_app, max_threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_threads,
+                                           thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = io.BytesIO()
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        # one message in flight: the app thread waits for the client
+        messages = asyncio.Queue(maxsize=1)
+        abandoned = threading.Event()
+        environ = build_environ(scope, body)
+        task = loop.run_in_executor(self.executor, self.run, environ,
+                                    loop, messages, abandoned)
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                if isinstance(message, BaseException):
+                    raise message
+                if isinstance(message, AsyncBody):
+                    await self.stream(message.chunks, receive, send)
+                    break
+                await send(message)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            abandoned.set()
+            await task
+
+    async def stream(self, chunks, receive, send):
+        # the only message left to receive is the client's disconnect
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            async for chunk in chunks:
+                if (disconnect.done()
+                        and disconnect.result()['type'] == 'http.disconnect'):
+                    break
+                await send({'type': 'http.response.body',
+                            'body': chunk.encode('utf-8'), 'more_body': True})
+        finally:
+            disconnect.cancel()
+            await chunks.aclose()
+
+    def run(self, environ, loop, messages, abandoned):
+        """
+        Runs the whole response on one pool thread, streamed bodies
+        included, since Flask's request context is bound to its thread.
+        An ASYNC_BODY is passed back to the event loop instead.
+        """
+        def put(message):
+            future = asyncio.run_coroutine_threadsafe(messages.put(message), loop)
+            while True:
+                try:
+                    return future.result(timeout=1)
+                except FutureTimeout:
+                    if abandoned.is_set():
+                        future.cancel()
+                        raise ClientGone()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers],
+            }
+
+        try:
+            chunks = self.wsgi_app(environ, start_response)
+            async_body = environ.get(ASYNC_BODY)
+            if async_body is not None and 'start' in response:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+                put(response.pop('start'))
+                put(AsyncBody(async_body))
+                return
+            try:
+                for chunk in chunks:
+                    if 'start' in response:
+                        put(response.pop('start'))
+                    if chunk:
+                        put({'type': 'http.response.body',
+                             'body': chunk, 'more_body': True})
+                if 'start' in response:
+                    put(response.pop('start'))
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            put(None)
+        except ClientGone:
+            pass
+        except Exception as error:
+            if not abandoned.is_set():
+                put(error)
+
+
+class ClientGone(Exception):
+    pass
+
+
+class AsyncBody:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    flask_app = create_app(test_config)
+    # one thread per pooled database connection
+    max_threads = flask_app.config['ASGI_THREADS'] or (
+        flask_app.config['DB_POOL_SIZE'] + flask_app.config['DB_MAX_OVERFLOW'])
+    return AsgiApp(flask_app.wsgi_app, max_threads)
+
+
+def __getattr__(name):
+    # `uvicorn asgi:app` builds the app on first access, not on import
+    if name == 'app':
+        globals()['app'] = create_asgi_app()
+        return globals()['app']
+    raise AttributeError(name)
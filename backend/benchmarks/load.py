@@ -0,0 +1,404 @@
+"""
+Load benchmark
+
+Seeds a synthetic question bank into a local database, replays a realistic
+mix of list, category, search, quiz-turn and create/delete traffic and
+reports p50/p95/p99 latency and throughput per endpoint, and the peak RSS
+of the run.
+
+    python benchmarks/load.py --questions 100000 --modes test-client wsgi asgi \\
+        --output results.json [--compare previous.json]
+
+Modes:
+    test-client  in-process Flask test client, one request at a time
+    wsgi         threaded werkzeug server, --concurrency client threads
+    asgi         uvicorn serving asgi.py (if installed), same clients
+
+The database defaults to a fresh SQLite file; pass --database-url to use a
+local PostgreSQL database instead (it is seeded only when empty).
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from flaskr import create_app  # noqa: E402
+from models import db, init_db, Category, Question  # noqa: E402
+from bulk import import_questions  # noqa: E402
+
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+
+# endpoint -> share of the traffic
+TRAFFIC_MIX = {
+    'list': 35,
+    'category': 20,
+    'search': 15,
+    'quiz': 20,
+    'create': 5,
+    'delete': 5,
+}
+
+WORDS = ('which what who river painter planet king battle team song film '
+         'novel ocean mountain city element war empire league composer '
+         'island desert poet theorem capital dynasty olympic opera').split()
+
+
+def peak_rss_mb():
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss_kb //= 1024
+    return rss_kb / 1024
+
+
+def synthetic_questions(count, categories, seed=1):
+    generator = random.Random(seed)
+    for number in range(1, count + 1):
+        words = generator.sample(WORDS, 6)
+        yield number, {
+            'question': '{} {}?'.format(' '.join(words).capitalize(), number),
+            'answer': generator.choice(WORDS).title(),
+            'difficulty': generator.randint(1, 5),
+            'category': generator.choice(categories),
+        }
+
+
+"""
+seed_bank(app, questions)
+    creates the tables, the categories and `questions` synthetic questions
+    unless the bank already holds questions
+"""
+def seed_bank(app, questions):
+    with app.app_context():
+        init_db()
+        if not Category.query.count():
+            for name in CATEGORIES:
+                db.session.add(Category(type=name))
+            db.session.commit()
+            Category.cache.invalidate()
+        existing = Question.query.count()
+        if not existing:
+            start = time.perf_counter()
+            import_questions(synthetic_questions(
+                questions, list(Category.as_dict())))
+            print('seeded {} questions in {:.1f}s'.format(
+                questions, time.perf_counter() - start), file=sys.stderr)
+        return sorted(Category.as_dict())
+
+
+"""
+Traffic
+    builds the next request of the mix and remembers the questions it
+    created so the deletes don't eat into the seeded bank
+"""
+class Traffic:
+
+    def __init__(self, questions, categories, seed):
+        self.random = random.Random(seed)
+        self.pages = max(questions // 10, 1)
+        self.categories = categories
+        self.created = []
+        self.endpoints = [name for name, share in TRAFFIC_MIX.items()
+                          for _ in range(share)]
+
+    def next(self):
+        endpoint = self.random.choice(self.endpoints)
+        if endpoint == 'delete' and not self.created:
+            endpoint = 'create'
+
+        if endpoint == 'list':
+            return endpoint, 'GET', '/questions?page={}'.format(
+                self.random.randint(1, self.pages)), None
+        if endpoint == 'category':
+            return endpoint, 'GET', '/categories/{}/questions?page={}'.format(
+                self.random.choice(self.categories),
+                self.random.randint(1, 5)), None
+        if endpoint == 'search':
+            return endpoint, 'POST', '/questions', {
+                'searchTerm': self.random.choice(WORDS)}
+        if endpoint == 'quiz':
+            category = self.random.choice([0] + self.categories)
+            return endpoint, 'POST', '/quizzes', {
+                'previous_questions': self.random.sample(range(1, 200), 4),
+                'quiz_category': {'id': category, 'type': 'benchmark'}}
+        if endpoint == 'create':
+            return endpoint, 'POST', '/questions', {
+                'question': 'Benchmark question {}?'.format(self.random.random()),
+                'answer': 'Benchmark',
+                'difficulty': 1,
+                'category': self.random.choice(self.categories)}
+        return endpoint, 'DELETE', '/questions/{}'.format(self.created.pop()), None
+
+    def record(self, endpoint, status, body):
+        if endpoint == 'create' and status == 200:
+            self.created.append(json.loads(body)['created'])
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, seconds, status):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds * 1000)
+            if status >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, wall_seconds):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors.get(endpoint, 0),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'throughput_rps': len(latencies) / wall_seconds,
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'requests': total,
+            'wall_seconds': wall_seconds,
+            'throughput_rps': total / wall_seconds,
+            'peak_rss_mb': peak_rss_mb(),
+            'endpoints': endpoints,
+        }
+
+
+def percentile(ordered, rank):
+    # nearest-rank percentile of an ascending list
+    index = max(int(round(rank / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def run_test_client(app, traffic, requests):
+    client = app.test_client()
+    recorder = Recorder()
+    start = time.perf_counter()
+    for _ in range(requests):
+        endpoint, method, path, body = traffic.next()
+        sent = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        recorder.add(endpoint, time.perf_counter() - sent, response.status_code)
+        traffic.record(endpoint, response.status_code, response.data)
+    return recorder.report(time.perf_counter() - start)
+
+
+def run_http(port, traffic, requests, concurrency):
+    recorder = Recorder()
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+                endpoint, method, path, body = traffic.next()
+            payload = None if body is None else json.dumps(body)
+            headers = {'Content-Type': 'application/json'} if body else {}
+            sent = time.perf_counter()
+            try:
+                connection.request(method, path, payload, headers)
+                response = connection.getresponse()
+                data = response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                data, status = b'', 599
+            recorder.add(endpoint, time.perf_counter() - sent, status)
+            with lock:
+                traffic.record(endpoint, status, data)
+            # no response to read the header of after a failure
+            if status == 599 or response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.perf_counter() - start)
+
+
+def run_wsgi(app, traffic, requests, concurrency):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        return run_http(server.server_port, traffic, requests, concurrency)
+    finally:
+        server.shutdown()
+
+
+def run_asgi(database_url, config, traffic, requests, concurrency):
+    # separate process, so its RSS isn't mixed with ours
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url,
+               **{key: str(value) for key, value in config.items()})
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port),
+         '--log-level', 'warning'], cwd=BACKEND, env=env)
+    try:
+        wait_for_port(port)
+        result = run_http(port, traffic, requests, concurrency)
+        result['note'] = 'peak_rss_mb is the benchmark client, not the server'
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start on port {}'.format(port))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+"""
+compare(previous, current, tolerance)
+    p95 regressions of more than `tolerance` (0.2 = 20%) per mode and endpoint
+"""
+def compare(previous, current, tolerance):
+    regressions = []
+    for mode, result in current['modes'].items():
+        before = previous.get('modes', {}).get(mode)
+        if not before:
+            continue
+        for endpoint, figures in result['endpoints'].items():
+            old = before['endpoints'].get(endpoint)
+            if old and figures['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                regressions.append('{} {}: p95 {:.1f}ms -> {:.1f}ms'.format(
+                    mode, endpoint, old['p95_ms'], figures['p95_ms']))
+    return regressions
+
+
+def parse_config(pairs):
+    config = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        config[key] = int(value) if value.lstrip('-').isdigit() else value
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per mode')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--modes', nargs='+', default=['test-client', 'wsgi'],
+                        choices=['test-client', 'wsgi', 'asgi'])
+    parser.add_argument('--database-url')
+    parser.add_argument('--config', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='app config overrides, e.g. HTTP_BODY_CACHE_TTL=0')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(
+            directory, 'load.db')
+        config = parse_config(args.config)
+        app = create_app(dict(config, DATABASE_URL=database_url))
+        categories = seed_bank(app, args.questions)
+
+        results = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'database': app.config['DATABASE_URL'].split('://')[0],
+            'questions': args.questions,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'config': config,
+            'modes': {},
+        }
+        for mode in args.modes:
+            traffic = Traffic(args.questions, categories, args.seed)
+            if mode == 'test-client':
+                result = run_test_client(app, traffic, args.requests)
+            elif mode == 'wsgi':
+                result = run_wsgi(app, traffic, args.requests, args.concurrency)
+            else:
+                result = run_asgi(database_url, config, traffic,
+                                  args.requests, args.concurrency)
+            results['modes'][mode] = result
+            print_mode(mode, result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(json.load(previous), results, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def print_mode(mode, result):
+    print('{} - {:.0f} req/s, peak RSS {:.0f} MB'.format(
+        mode, result['throughput_rps'], result['peak_rss_mb']))
+    print('  {:<10}{:>8}{:>8}{:>9}{:>9}{:>9}'.format(
+        'endpoint', 'reqs', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, figures in result['endpoints'].items():
+        print('  {:<10}{:>8}{:>8}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+            endpoint, figures['requests'], figures['errors'],
+            figures['p50_ms'], figures['p95_ms'], figures['p99_ms']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Startup benchmark
+
+Measures, in a fresh interpreter, how long `import flaskr` takes, how long
+`create_app()` takes, the time to the first served page of questions and
+the peak RSS of the process, against a throwaway SQLite database holding
+the trivia.psql questions. The import is also compared with a bare
+`import flask` timed the same way, which keeps the budget meaningful on
+slower machines.
+Exits with status 1 when the import time is over either budget.
+
+    python benchmarks/startup.py [--budget-ms 1000] [--budget-ratio 3]
+                                 [--runs 5] [--json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_MS = 1000
+# import flaskr over import flask
+IMPORT_BUDGET_RATIO = 3
+
+# runs in the child interpreter, prints one json line
+PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import flaskr
+imported = time.perf_counter()
+app = flaskr.create_app({'DATABASE_URL': sys.argv[1]})
+created = time.perf_counter()
+response = app.test_client().get('/questions?page=1')
+served = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'time_to_first_request_ms': (served - start) * 1000,
+    'status': response.status_code,
+    'peak_rss_mb': rss_kb / 1024,
+}))
+'''
+
+BASELINE = '''
+import json, time
+start = time.perf_counter()
+import flask
+print(json.dumps({'flask_import_ms': (time.perf_counter() - start) * 1000}))
+'''
+
+SETUP = '''
+import sys
+import flaskr
+from models import init_db, load_fixture
+app = flaskr.create_app({'DATABASE_URL': sys.argv[1]})
+with app.app_context():
+    init_db()
+    load_fixture('trivia.psql')
+'''
+
+
+def run(code, database_url):
+    return subprocess.run(
+        [sys.executable, '-c', code, database_url],
+        cwd=BACKEND, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout
+
+
+"""
+measure_startup(runs)
+    median figures over `runs` fresh interpreters, with `import_ratio`,
+    the flaskr import time over the bare flask one
+"""
+def measure_startup(runs=5):
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = 'sqlite:///' + os.path.join(directory, 'startup.db')
+        run(SETUP, database_url)
+        samples = []
+        for _ in range(runs):
+            # interleaved, so both see the same machine load
+            sample = json.loads(run(PROBE, database_url).splitlines()[-1])
+            # an error page would time the wrong thing
+            if sample['status'] != 200:
+                raise RuntimeError('first request answered {}'.format(
+                    sample['status']))
+            sample.update(json.loads(run(BASELINE, database_url).splitlines()[-1]))
+            samples.append(sample)
+    result = {key: statistics.median(sample[key] for sample in samples)
+              for key in samples[0]}
+    result['import_ratio'] = result['import_ms'] / result['flask_import_ms']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS,
+                        help='maximum import time of flaskr')
+    parser.add_argument('--budget-ratio', type=float, default=IMPORT_BUDGET_RATIO,
+                        help='maximum import time of flaskr over that of flask')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print json only')
+    args = parser.parse_args()
+
+    result = measure_startup(args.runs)
+    result['import_budget_ms'] = args.budget_ms
+    result['import_budget_ratio'] = args.budget_ratio
+    result['within_budget'] = (result['import_ms'] <= args.budget_ms
+                               and result['import_ratio'] <= args.budget_ratio)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print('{:<26}{}'.format(key, round(value, 1)
+                                    if isinstance(value, float) else value))
+    return 0 if result['within_budget'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Bulk question import/export
+
+Question packs are streamed as NDJSON (one json object per line) or CSV
+with a header row, both with the fields question, answer, difficulty and
+category. Imports are validated against the cached category map and
+inserted in chunked transactions (COPY on PostgreSQL, executemany
+elsewhere). Exports stream from a server-side cursor, one chunk at a time,
+so neither side holds the whole table in memory.
+"""
+
+import csv
+import io
+import json
+
+from models import db, read_session, Question, Category, notify_question_change
+
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+FIELDS = ['question', 'answer', 'difficulty', 'category']
+EXPORT_FIELDS = ['id'] + FIELDS
+
+
+def decode_lines(lines):
+    # bytes that aren't utf-8 are kept as lone surrogates, so the line
+    # survives parsing and validate() rejects its row
+    for line in lines:
+        yield (line.decode('utf-8', 'surrogateescape')
+               if isinstance(line, bytes) else line)
+
+
+"""
+parse_ndjson(lines) / parse_csv(lines)
+    yield (line number, row dict) from an iterable of text or bytes lines
+"""
+def parse_ndjson(lines):
+    for number, line in enumerate(decode_lines(lines), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row
+
+
+def parse_csv(lines):
+    reader = csv.DictReader(decode_lines(lines))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def validate(row, categories):
+    """Returns the insertable values of `row`, or raises ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError('not a json object')
+
+    values = {}
+    for field in ('question', 'answer'):
+        value = row.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('missing {}'.format(field))
+        try:
+            value.encode('utf-8', 'strict')
+        except UnicodeEncodeError:
+            raise ValueError('{} is not valid utf-8'.format(field))
+        values[field] = value
+
+    for field in ('difficulty', 'category'):
+        try:
+            values[field] = int(row.get(field))
+        except (TypeError, ValueError):
+            raise ValueError('{} must be an integer'.format(field))
+
+    if values['category'] not in categories:
+        raise ValueError('unknown category {}'.format(values['category']))
+    return values
+
+
+def insert_chunk(rows):
+    """Inserts a list of validated rows in one transaction."""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # COPY is the fastest way into PostgreSQL
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in FIELDS])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert('COPY questions ({}) FROM STDIN WITH (FORMAT csv)'
+                               .format(', '.join(FIELDS)), buffer)
+        finally:
+            cursor.close()
+    else:
+        connection.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+
+
+"""
+import_questions(rows, chunk_size)
+    validates and inserts (line number, row) pairs; invalid rows are skipped
+    and reported. Ids in the input are ignored, new ones are assigned.
+"""
+def import_questions(rows, chunk_size=CHUNK_SIZE):
+    categories = Category.as_dict()
+    imported = 0
+    errors = []
+    chunk = []
+
+    try:
+        for number, row in rows:
+            try:
+                chunk.append(validate(row, categories))
+            except ValueError as error:
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': number, 'message': str(error)})
+                continue
+
+            if len(chunk) >= chunk_size:
+                insert_chunk(chunk)
+                imported += len(chunk)
+                chunk = []
+
+        if chunk:
+            insert_chunk(chunk)
+            imported += len(chunk)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # counters and indexes are rebuilt from the table
+        if imported:
+            notify_question_change('reset')
+
+    return imported, errors
+
+
+"""
+export_questions(file_format, chunk_size)
+    yields the whole table as NDJSON or CSV text, chunk by chunk
+"""
+def export_questions(file_format='ndjson', chunk_size=CHUNK_SIZE):
+    columns = [getattr(Question, field) for field in EXPORT_FIELDS]
+    rows = (read_session().query(*columns)
+            .order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(chunk_size))
+
+    buffer = io.StringIO()
+    if file_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        write = writer.writerow
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+            buffer.write('\n')
+
+    for number, row in enumerate(rows, start=1):
+        write(row)
+        if number % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,70 @@
+"""
+Category cache
+
+Categories almost never change, so the `{id: type}` map the endpoints send
+to the frontend is loaded once and served from memory for `ttl` seconds.
+Call `invalidate()` after changing the categories table.
+"""
+
+import hashlib
+import threading
+import time
+
+
+CATEGORY_CACHE_TTL = 5 * 60
+
+
+def digest(categories):
+    text = repr(sorted(categories.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+class CategoryCache:
+
+    def __init__(self, loader, ttl=CATEGORY_CACHE_TTL):
+        # loader() returns a fresh {id: type} dict from the database
+        self.loader = loader
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # digest of the map, for ETags: it only changes when the map does,
+        # and is the same in every worker process
+        self.version = None
+        self._categories = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the cached {id: type} map. Callers must not modify it."""
+        categories = self._categories
+        if categories is not None and time.time() < self._expires_at:
+            self.hits += 1
+            return categories
+
+        with self._lock:
+            # another thread may have reloaded while we waited
+            if self._categories is None or time.time() >= self._expires_at:
+                self.misses += 1
+                categories = self.loader()
+                if categories != self._categories:
+                    self.version = digest(categories)
+                self._categories = categories
+                self._expires_at = time.time() + self.ttl
+            else:
+                self.hits += 1
+            return self._categories
+
+    def exists(self, category_id):
+        return category_id in self.get()
+
+    def invalidate(self):
+        with self._lock:
+            # reloaded on the next get(), kept to compare with until then
+            self._expires_at = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': time.time() < self._expires_at
+        }
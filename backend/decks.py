@@ -0,0 +1,274 @@
+"""
+Quiz decks
+
+Compact arrays of question ids, one per category plus one for "All"
+(category 0), kept in memory so a quiz turn doesn't have to filter and
+shuffle the questions table. The decks are built in a background thread at
+startup, kept up to date on Question.insert/update/delete and reconciled
+with the database by the same thread every `ttl` seconds to pick up
+changes made by other workers, and before the next turn after a reset
+(bulk import, fixture load, serve.py reload).
+
+A game walks its deck in the order of an affine permutation
+(position = a * cursor + b mod size) derived from a per-game seed, so a
+game only needs (seed, cursor, size) to know which question comes next.
+Deleted questions are left as 0 in their slot and new ones are appended,
+so positions don't move under a running game, resets included.
+
+With cache_rows on, the question payloads are kept in memory as well and
+quiz turns don't touch the database at all; with a question snapshot
+(SNAPSHOT_PATH) they are read from the snapshot instead.
+"""
+
+import math
+import random
+import threading
+from array import array
+from collections import defaultdict
+
+from models import Question, question_columns, format_question_row, on_question_change
+from snapshot import snapshots
+
+
+DECK_TTL = 5 * 60
+ALL = 0
+
+# question_columns order: id, question, answer, category, difficulty
+CATEGORY = 3
+
+
+"""
+permutation(seed, size)
+    (a, b) of the affine permutation of range(size) a game is dealt with
+"""
+def permutation(seed, size):
+    generator = random.Random(seed)
+    if size <= 1:
+        return 1, 0
+    while True:
+        a = generator.randrange(1, size)
+        if math.gcd(a, size) == 1:
+            return a, generator.randrange(size)
+
+
+def new_seed():
+    return random.getrandbits(32)
+
+
+"""
+without_answer(question)
+    the question as dealt to a player: its answer is only sent once the
+    player's answer has been judged
+"""
+def without_answer(question):
+    return {key: value for key, value in question.items() if key != 'answer'}
+
+
+class Decks:
+
+    def __init__(self, ttl=DECK_TTL, cache_rows=False):
+        self.ttl = ttl
+        self.cache_rows = cache_rows
+        # category -> array of question ids, 0 where a question was removed
+        self._decks = None
+        # category -> {question id: position in its deck}
+        self._positions = {}
+        # category -> number of non-zero ids
+        self._live = {}
+        # question id -> question_columns row, with cache_rows on
+        self._rows = None
+        # set on reset, until the decks are reconciled with the table
+        self._stale = False
+        # bumped on reset, so a load started before it doesn't clear _stale
+        self._resets = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loader = None
+        self._stopping = threading.Event()
+
+    def start(self, app):
+        """
+        Builds the decks in a background thread, which then reconciles them
+        with the table every `ttl` seconds until stop().
+        """
+        self.stop()
+        stopping = self._stopping = threading.Event()
+
+        def run():
+            # decks warmed before a fork are only reconciled after the ttl
+            if self._decks is not None and stopping.wait(max(self.ttl, 1)):
+                return
+            while True:
+                with app.app_context():
+                    try:
+                        self._load(reconcile=True)
+                    except Exception as error:
+                        # e.g. no tables yet; requests load the decks themselves
+                        app.logger.warning('quiz decks not built: %s', error)
+                if stopping.wait(max(self.ttl, 1)):
+                    return
+        self._loader = threading.Thread(target=run, daemon=True,
+                                        name='quiz-decks')
+        self._loader.start()
+
+    def stop(self):
+        """Stops the background thread, e.g. before forking."""
+        self._stopping.set()
+        if self._loader is not None:
+            self._loader.join()
+            self._loader = None
+
+    def warm(self):
+        """Reconciles the decks with the table now."""
+        self._load(reconcile=True)
+
+    def _load(self, reconcile=False):
+        if self._decks is not None and not self._stale and not reconcile:
+            return
+        # while one thread reloads after a reset, the others keep using the
+        # decks as they were
+        if not self._load_lock.acquire(blocking=self._decks is None or reconcile):
+            return
+        try:
+            if self._decks is not None and not self._stale and not reconcile:
+                return
+            resets = self._resets
+            fresh = defaultdict(list)
+            rows = {} if self.cache_rows else None
+            columns = (question_columns if self.cache_rows
+                       else (Question.id, Question.category))
+            for row in Question.query.with_entities(*columns).order_by(Question.id):
+                question_id = row[0]
+                category = row[CATEGORY] if self.cache_rows else row[1]
+                fresh[ALL].append(question_id)
+                if category is not None:
+                    fresh[int(category)].append(question_id)
+                if rows is not None:
+                    rows[question_id] = tuple(row)
+
+            with self._lock:
+                if self._decks is None:
+                    self._decks = {}
+                self._merge(fresh)
+                if resets == self._resets:
+                    self._rows = rows
+                    self._stale = False
+        finally:
+            self._load_lock.release()
+
+    def _merge(self, fresh):
+        # keeps every position: gone ids become 0, new ones are appended
+        for category in set(fresh) | set(self._decks):
+            deck = self._decks.setdefault(category, array('i'))
+            positions = self._positions.setdefault(category, {})
+            wanted = set(fresh.get(category, ()))
+            for question_id in [question_id for question_id in positions
+                                if question_id not in wanted]:
+                deck[positions.pop(question_id)] = 0
+            for question_id in fresh.get(category, ()):
+                if question_id not in positions:
+                    positions[question_id] = len(deck)
+                    deck.append(question_id)
+            self._live[category] = len(positions)
+
+    def question_changed(self, action, question):
+        if action == 'reset':
+            # positions are kept: running games go on with the same decks,
+            # reconciled with the table before their next turn
+            with self._lock:
+                self._resets += 1
+                self._stale = True
+                self._rows = None
+            return
+
+        # read the attributes before locking, they may need a query
+        row = tuple(getattr(question, column.key) for column in question_columns)
+        question_id = row[0]
+        category = None if row[CATEGORY] is None else int(row[CATEGORY])
+        with self._lock:
+            if self._decks is None:
+                return
+            if action == 'insert':
+                self._append(ALL, question_id)
+                if category is not None:
+                    self._append(category, question_id)
+            elif action == 'delete':
+                for deck_category in self._decks:
+                    self._remove(deck_category, question_id)
+            else:
+                # the category may have changed, "All" stays as it is
+                for deck_category in self._decks:
+                    if deck_category not in (ALL, category):
+                        self._remove(deck_category, question_id)
+                if category is not None:
+                    self._append(category, question_id)
+            if self._rows is not None:
+                if action == 'delete':
+                    self._rows.pop(question_id, None)
+                else:
+                    self._rows[question_id] = row
+
+    def _remove(self, category, question_id):
+        position = self._positions[category].pop(question_id, None)
+        if position is None:
+            return
+        self._decks[category][position] = 0
+        self._live[category] -= 1
+
+    def _append(self, category, question_id):
+        positions = self._positions.setdefault(category, {})
+        if question_id in positions:
+            return
+        deck = self._decks.setdefault(category, array('i'))
+        positions[question_id] = len(deck)
+        deck.append(question_id)
+        self._live[category] = len(positions)
+
+    def _deck(self, category):
+        self._load()
+        with self._lock:
+            return (self._decks.get(category, array('i')),
+                    self._live.get(category, 0))
+
+    def deal(self, category=ALL):
+        """(size, live questions) of the deck a new game is dealt from."""
+        deck, live = self._deck(category)
+        return len(deck), live
+
+    def question(self, question_id):
+        """Question.format() of one question, None if it is gone."""
+        rows = self._rows
+        row = rows.get(question_id) if rows is not None else None
+        if row is None:
+            snapshot = snapshots.current()
+            position = snapshot.find(question_id) if snapshot is not None else None
+            if position is not None:
+                return format_question_row(snapshot.row(position))
+            # added since the snapshot was built, or no snapshot
+            row = (Question.query.with_entities(*question_columns)
+                   .filter(Question.id == question_id).first())
+        return None if row is None else format_question_row(row)
+
+    """
+    next_question(category, seed, cursor, size, exclude)
+        the first question at or after `cursor` in the game's order that
+        isn't in `exclude`, and the cursor of the turn after it.
+        Returns (None, size) once the deck is exhausted.
+    """
+    def next_question(self, category, seed, cursor, size, exclude=()):
+        deck, _ = self._deck(category)
+        a, b = permutation(seed, size)
+        while cursor < size:
+            position = (a * cursor + b) % size
+            cursor += 1
+            question_id = deck[position] if position < len(deck) else 0
+            if not question_id or question_id in exclude:
+                continue
+            question = self.question(question_id)
+            if question is not None:
+                return question, cursor
+        return None, size
+
+
+decks = Decks()
+on_question_change(decks.question_changed)
@@ -1,24 +1,133 @@
-from curses import raw
-from distutils.log import debug
-import json
 import os
-from unicodedata import category
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, abort, jsonify, Response, stream_with_context
 from flask_cors import CORS, cross_origin
-import random
-from matplotlib.style import available
+import click
 
-from sqlalchemy import false
-
-from models import setup_db, Question, Category
+from models import (db, setup_db, init_db, read_session, database_path,
+                    Question, Category, QUESTION_FIELDS, format_question_row)
+from quiz_sessions import make_session_store, SESSION_TTL
+from rooms import RoomRegistry, ROOM_TTL, ROOM_KEEPALIVE, MAX_PLAYER_NAME
+from stats import quiz_stats, correct_answer, STATS_FLUSH_MS, LEADERBOARD_SIZE
+from decks import decks, new_seed, without_answer, DECK_TTL, ALL
+from category_cache import CATEGORY_CACHE_TTL
+from search import (make_search, create_search_index, escape_like,
+                    SEARCH_INDEX_TTL)
+from question_counts import question_counts, QUESTION_COUNTS_TTL
+from snapshot import snapshots, build_snapshot
+from write_queue import (write_queue, QueueFull, WRITE_QUEUE_SIZE,
+                         WRITE_BATCH_SIZE, WRITE_FLUSH_MS)
+from bulk import import_questions, export_questions, parse_csv, parse_ndjson
+from .http_cache import (conditional_get, data_version, HTTP_CACHE_MAX_AGE,
+                         HTTP_BODY_CACHE_TTL)
+from .fast_json import json_response
+from .compression import compress_responses, COMPRESS_MIN_SIZE, COMPRESS_LEVEL
+from .metrics import instrument, metrics, PROFILE_INTERVAL_MS, PROFILE_DIR
 
 QUESTIONS_PER_PAGE = 10
+# largest ?per_page= accepted by the question listings
+MAX_QUESTIONS_PER_PAGE = 1000
+# ?sort= orders of the question listings, ties broken by id
+QUESTION_SORTS = {
+    'id': (Question.id,),
+    '-id': (Question.id.desc(),),
+    'difficulty': (Question.difficulty, Question.id),
+    '-difficulty': (Question.difficulty.desc(), Question.id.desc()),
+}
+# questions returned by POST /quizzes/batch, by default and at most
+QUIZ_BATCH_SIZE = 5
+MAX_QUIZ_BATCH_SIZE = 50
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(
+        # 'memory', or 'sqlite:///<path>' to share sessions between workers
+        QUIZ_SESSION_STORE=os.getenv('QUIZ_SESSION_STORE', 'memory'),
+        QUIZ_SESSION_TTL=int(os.getenv('QUIZ_SESSION_TTL', SESSION_TTL)),
+        # multiplayer rooms are dropped after this many idle seconds; their
+        # event streams send a keep-alive every ROOM_KEEPALIVE seconds
+        ROOM_TTL=int(os.getenv('ROOM_TTL', ROOM_TTL)),
+        ROOM_KEEPALIVE=int(os.getenv('ROOM_KEEPALIVE', ROOM_KEEPALIVE)),
+        # rooms live in one process: serve.py turns them off when it runs
+        # several workers, as should any other multi-process server
+        ROOMS=os.getenv('ROOMS', '1') == '1',
+        # NDJSON log of the quiz answers the statistics are rebuilt from,
+        # appended every STATS_FLUSH_MS; unset to keep them in memory only
+        STATS_LOG=os.getenv('STATS_LOG'),
+        STATS_FLUSH_MS=int(os.getenv('STATS_FLUSH_MS', STATS_FLUSH_MS)),
+        # seconds between reconciling the quiz decks with the database, and
+        # whether the decks keep the question payloads too
+        QUIZ_DECK_TTL=int(os.getenv('QUIZ_DECK_TTL', DECK_TTL)),
+        QUIZ_DECK_CACHE_ROWS=os.getenv('QUIZ_DECK_CACHE_ROWS', '0') == '1',
+        CATEGORY_CACHE_TTL=int(os.getenv('CATEGORY_CACHE_TTL',
+                                         CATEGORY_CACHE_TTL)),
+        # 'auto', 'postgres' (pg_trgm index) or 'memory' (in-process index)
+        SEARCH_BACKEND=os.getenv('SEARCH_BACKEND', 'auto'),
+        SEARCH_INDEX_TTL=int(os.getenv('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL)),
+        # per-category question counters kept in memory
+        QUESTION_COUNTS_CACHED=os.getenv('QUESTION_COUNTS_CACHED', '1') == '1',
+        QUESTION_COUNTS_TTL=int(os.getenv('QUESTION_COUNTS_TTL',
+                                          QUESTION_COUNTS_TTL)),
+        # Cache-Control max-age of the read endpoints, clients revalidate
+        # with their ETag after it
+        HTTP_CACHE_MAX_AGE=int(os.getenv('HTTP_CACHE_MAX_AGE',
+                                         HTTP_CACHE_MAX_AGE)),
+        # seconds serialised bodies are kept in process, 0 to disable
+        HTTP_BODY_CACHE_TTL=int(os.getenv('HTTP_BODY_CACHE_TTL',
+                                          HTTP_BODY_CACHE_TTL)),
+        # file sharing the ETag data version between worker processes,
+        # serve.py makes one when it runs several
+        HTTP_VERSION_PATH=os.getenv('HTTP_VERSION_PATH'),
+        # Server-Timing header with the SQL/serialisation/total times
+        SERVER_TIMING=os.getenv('SERVER_TIMING', '0') == '1',
+        # dump sampled stacks of requests slower than this, 0 to disable
+        PROFILE_SLOW_MS=int(os.getenv('PROFILE_SLOW_MS', 0)),
+        PROFILE_INTERVAL_MS=int(os.getenv('PROFILE_INTERVAL_MS',
+                                          PROFILE_INTERVAL_MS)),
+        PROFILE_DIR=os.getenv('PROFILE_DIR', PROFILE_DIR),
+        # gzip/brotli responses of at least this many bytes, 0 to disable
+        COMPRESS_MIN_SIZE=int(os.getenv('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)),
+        COMPRESS_LEVEL=int(os.getenv('COMPRESS_LEVEL', COMPRESS_LEVEL)),
+        # file of the mmapped question snapshot serving the listings, quiz
+        # turns and search without the database, unset to disable
+        SNAPSHOT_PATH=os.getenv('SNAPSHOT_PATH'),
+        # queue question inserts/deletes and commit them in batches, at most
+        # WRITE_FLUSH_MS after they were queued (see write_queue.py)
+        WRITE_BEHIND=os.getenv('WRITE_BEHIND', '0') == '1',
+        WRITE_QUEUE_SIZE=int(os.getenv('WRITE_QUEUE_SIZE', WRITE_QUEUE_SIZE)),
+        WRITE_BATCH_SIZE=int(os.getenv('WRITE_BATCH_SIZE', WRITE_BATCH_SIZE)),
+        WRITE_FLUSH_MS=int(os.getenv('WRITE_FLUSH_MS', WRITE_FLUSH_MS)),
+        # request threads of asgi.py, 0 for DB_POOL_SIZE + DB_MAX_OVERFLOW
+        ASGI_THREADS=int(os.getenv('ASGI_THREADS', 0)),
+    )
+    if test_config is not None:
+        app.config.update(test_config)
+    setup_db(app, app.config.get('DATABASE_URL', database_path))
+    Category.cache.ttl = app.config['CATEGORY_CACHE_TTL']
+    question_counts.cached = app.config['QUESTION_COUNTS_CACHED']
+    question_counts.ttl = app.config['QUESTION_COUNTS_TTL']
+    quiz_sessions = make_session_store(app.config['QUIZ_SESSION_STORE'],
+                                       app.config['QUIZ_SESSION_TTL'])
+    data_version.start(app.config['HTTP_VERSION_PATH'])
+    snapshots.start(app, app.config['SNAPSHOT_PATH'])
+    write_queue.stop()
+    if app.config['WRITE_BEHIND']:
+        write_queue.max_size = app.config['WRITE_QUEUE_SIZE']
+        write_queue.batch_size = app.config['WRITE_BATCH_SIZE']
+        write_queue.flush_interval = app.config['WRITE_FLUSH_MS'] / 1000
+        write_queue.start(app)
+    rooms = RoomRegistry(app.config['ROOM_TTL'])
+    quiz_stats.start(app.config['STATS_LOG'], app.config['STATS_FLUSH_MS'] / 1000)
+    decks.ttl = app.config['QUIZ_DECK_TTL']
+    decks.cache_rows = app.config['QUIZ_DECK_CACHE_ROWS']
+    decks.start(app)
+    question_search = make_search(app.config['SEARCH_BACKEND'],
+                                  app.config['SEARCH_INDEX_TTL'])
+    # for serve.py, which warms it before forking
+    app.extensions['question_search'] = question_search
+    # first, so its after_request hook runs last
+    instrument(app)
+    compress_responses(app)
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -36,19 +145,107 @@ def create_app(test_config=None):
         response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
         return response
     
+    # --- optional trimming of the question responses
+    def question_fields(request):
+        """
+        Fields of the question objects asked for with `?fields=a,b` (id is
+        always sent), all of them by default. 400 on unknown fields.
+        """
+        fields = request.args.get("fields")
+        if not fields:
+            return QUESTION_FIELDS
+        wanted = {field.strip() for field in fields.split(',') if field.strip()}
+        if not wanted <= set(QUESTION_FIELDS):
+            abort(400)
+        return tuple(field for field in QUESTION_FIELDS
+                     if field == 'id' or field in wanted)
+
+    def include_categories(request):
+        # the categories map is sent unless ?include= leaves it out
+        include = request.args.get("include")
+        return include is None or 'categories' in include.split(',')
+
     #Helper method
     # --- ten questions per page and pagination at the bottom of the screen
-    def paginate_questions(request, selection):
-        # Get page from request. If not given, default to 1
-        page = request.args.get("page", 1, type = int)
-        start = (page - 1)*QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-        #retrieve questions 
-        questions = [question.format() for question in selection]
-        show_questions = questions[start:end]
-
-        return show_questions
-    
+    def paginate_questions(request, selection, total=None):
+        """
+        Fetches one page of `selection` (an unexecuted Question query) and
+        the total number of rows it matches, counted with a COUNT query
+        unless already known.
+        LIMIT/OFFSET are pushed down to the database, so only the requested
+        page is loaded, as plain column tuples rather than ORM objects.
+        `?after_id=<id>` switches to cursor mode and returns the questions
+        following that id, which stays cheap for deep pages; otherwise
+        `?page=N` is used. `?per_page=N` (up to MAX_QUESTIONS_PER_PAGE)
+        changes the page size, `?sort=` the order (see QUESTION_SORTS) and
+        `?fields=` the columns selected.
+        """
+        # cheap COUNT of the full selection, without the ORDER BY
+        if total is None:
+            total = selection.order_by(None).count()
+
+        per_page, sort, after_id = page_args(request)
+        selection = selection.order_by(*QUESTION_SORTS.get(sort, QUESTION_SORTS['id']))
+        if after_id is not None:
+            # cursor mode follows the id order
+            selection = selection.filter(Question.id < after_id if sort == '-id'
+                                         else Question.id > after_id)
+        else:
+            # Get page from request. If not given, default to 1
+            page = request.args.get("page", 1, type = int)
+            if page < 1:
+                return [], total
+            selection = selection.offset((page - 1)*per_page)
+
+        #retrieve questions, only the columns asked for
+        fields = question_fields(request)
+        columns = [getattr(Question, field) for field in fields]
+        questions = [dict(zip(fields, row)) for row in
+                     selection.with_entities(*columns).limit(per_page)]
+
+        return questions, total
+
+    def page_args(request):
+        # (per_page, sort, after_id) of a question listing
+        per_page = request.args.get("per_page", QUESTIONS_PER_PAGE, type = int)
+        if per_page < 1 or per_page > MAX_QUESTIONS_PER_PAGE:
+            per_page = QUESTIONS_PER_PAGE
+        return (per_page, request.args.get("sort", "id"),
+                request.args.get("after_id", None, type = int))
+
+    def snapshot_page(request, category=None):
+        """
+        paginate_questions() of all the questions or one category's, read
+        from the question snapshot. None when there is no usable snapshot
+        or the order isn't by id, for the database to serve the page.
+        """
+        snapshot = snapshots.current()
+        per_page, sort, after_id = page_args(request)
+        if snapshot is None or sort not in ('id', '-id'):
+            return None
+
+        rows = snapshot.rows(category)
+        total = len(rows)
+        if after_id is not None:
+            # the rows past the cursor, in either direction
+            indexes = (range(snapshot.after(rows, after_id - 1) - 1, -1, -1)
+                       if sort == '-id' else
+                       range(snapshot.after(rows, after_id), total))
+        else:
+            page = request.args.get("page", 1, type = int)
+            if page < 1:
+                return [], total
+            start = (page - 1)*per_page
+            indexes = (range(total - 1 - start, -1, -1) if sort == '-id'
+                       else range(start, total))
+
+        fields = question_fields(request)
+        questions = []
+        for index in indexes[:per_page]:
+            question = format_question_row(snapshot.row(rows[index]))
+            questions.append({field: question[field] for field in fields})
+        return questions, total
+
     """
     @TODO:
     Create an endpoint to handle GET requests
@@ -57,21 +254,19 @@ def create_app(test_config=None):
 
     @app.route('/categories')
     @cross_origin()
+    @conditional_get
     def get_categories():
-        #retrieve categories from database
-        categories = Category.query.all()
-        #Changing formatting from {"id":1, "type":"science"} to {1:"science"}  
-        # as expected by frontend
-        formatted_categories = {category.id:category.type for category in categories}
+        #retrieve categories, formatted {1:"science"} as expected by frontend
+        formatted_categories = Category.as_dict()
 
         # Error if no category found
-        if not categories:
+        if not formatted_categories:
             abort(404)
 
         return jsonify({
             'success':True,
             'categories': formatted_categories,           
-            'total_categories': len(categories)
+            'total_categories': len(formatted_categories)
             })
 
     """
@@ -87,32 +282,83 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
 
+    # --- filters of GET /questions
+    def int_arg(name):
+        # None when not given, 400 when not an integer
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            abort(400)
+
+    def filter_questions(request, selection):
+        """
+        Applies the GET /questions filters to `selection`:
+        `?category=<id>`, `?difficulty=N` or a `?min_difficulty=`/
+        `?max_difficulty=` range, and `?q=<term>` for questions containing
+        the term. Everything ends up in the WHERE clause of the page query,
+        served by the (category, difficulty, id) and difficulty indexes.
+        Returns the filtered query and its total when already known.
+        """
+        category = int_arg('category')
+        difficulty = int_arg('difficulty')
+        min_difficulty = int_arg('min_difficulty')
+        max_difficulty = int_arg('max_difficulty')
+        term = request.args.get('q', '').strip()
+
+        if category is not None:
+            selection = selection.filter(Question.category == category)
+        if difficulty is not None:
+            min_difficulty = max_difficulty = difficulty
+        if min_difficulty is not None:
+            selection = selection.filter(Question.difficulty >= min_difficulty)
+        if max_difficulty is not None:
+            selection = selection.filter(Question.difficulty <= max_difficulty)
+        if term:
+            selection = selection.filter(Question.question.ilike(
+                '%{}%'.format(escape_like(term)), escape='\\'))
+
+        # the cached counters cover the unfiltered and per-category totals
+        if min_difficulty is None and max_difficulty is None and not term:
+            return selection, question_counts.total(category)
+        return selection, None
+
     @app.route('/questions')
     @cross_origin()
+    @conditional_get
     def get_all_questions():
-        #Retrieving questions in database
-        selection = Question.query.all()
-        # paginate the results
-        paginated = paginate_questions(request, selection)
+        # Error if the order is unknown, or not one cursor mode can follow
+        sort = request.args.get('sort', 'id')
+        if (sort not in QUESTION_SORTS
+                or ('after_id' in request.args and sort not in ('id', '-id'))):
+            abort(400)
+
+        # only the category filter is served from the snapshot
+        page = None
+        if not set(request.args) & {'difficulty', 'min_difficulty',
+                                    'max_difficulty', 'q'}:
+            page = snapshot_page(request, int_arg('category'))
+        if page is None:
+            # paginate the (filtered) questions in database
+            selection, total_questions = filter_questions(
+                request, read_session().query(Question))
+            page = paginate_questions(request, selection, total_questions)
+        paginated, total_questions = page
 
         #Error if no questions found
         if len(paginated) == 0:
             abort(404)
 
-        # get all categories from database and adding dictionary
-        categories = Category.query.all()
-        categories_dict = {}
-
-        for category in categories:
-            categories_dict[category.id] = category.type
-
-
-        return jsonify({
+        payload = {
             'success':True,
-            'categories': {category.id:category.type for category in categories},           
-            'total_questions': len(paginated),           
+            'total_questions': total_questions,           
             'questions': paginated,
-            })
+            }
+        if include_categories(request):
+            payload['categories'] = Category.as_dict()
+        return json_response(payload, 'questions')
  
     """
     @TODO:
@@ -128,21 +374,34 @@ def create_app(test_config=None):
             #Finding targeted question object in database
             question = Question.query.filter(Question.id == question_id).one_or_none()
             
+            # unless it is still waiting in the write-behind queue
+            if question is None and write_queue.running:
+                write_queue.flush()
+                question = Question.query.filter(Question.id == question_id).one_or_none()
+
             #Error if targetted question not found
             if question is None:
                abort(422)
 
-            question.delete()
-            selection = Question.query.all()
-            remaining_questions = paginate_questions(request, selection)
+            if write_queue.running:
+                # deleted already, just not committed yet
+                if not write_queue.delete(question):
+                    abort(422)
+            else:
+                question.delete()
+            remaining_questions, total_questions = paginate_questions(
+                request, Question.query,
+                question_counts.total(session=db.session))
             
             return jsonify({
                 "success": True,
                 "deleted": question_id,
                 "questions": remaining_questions,
-                "total_questions": len(Question.query.all())
+                "total_questions": total_questions
             })
             
+        except QueueFull:
+            abort(503)
         except:
             abort(422)
     
@@ -179,20 +438,19 @@ def create_app(test_config=None):
             # 404 if search body empty
             if search_term is None:
                 abort(404)
-            #filtering by search_term
-            selection = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
-            
-            #Paginate for display depending on number of matches
-            if (len(selection) > QUESTIONS_PER_PAGE):    
-                result = paginate_questions(request, selection)
-            else:
-                result = [question.format() for question in selection]
+            #ranked matches for search_term, one page at a time
+            result, total_questions = question_search.search(
+                search_term, request.args.get("page", 1, type = int),
+                QUESTIONS_PER_PAGE)
+            fields = question_fields(request)
+            if fields != QUESTION_FIELDS:
+                result = [{field: question[field] for field in fields}
+                          for question in result]
 
             return jsonify({
                 'success': True,
                 'questions': result,
-                'total_questions': len(Question.query.all())
+                'total_questions': total_questions
             })
         # otherwise create new question
         else:
@@ -211,26 +469,117 @@ def create_app(test_config=None):
                 # create and insert new question
                 question = Question(question = new_question, 
                                     answer = new_answer,
-                                    difficulty=new_difficulty, 
-                                    category=new_category)
-                question.insert()
+                                    difficulty=int(new_difficulty), 
+                                    category=int(new_category))
+                # with write-behind, the id now and the row with the next batch
+                if write_queue.running:
+                    write_queue.insert(question)
+                else:
+                    question.insert()
 
-                # get all questions and paginate
-                selection = Question.query.order_by(Question.id).all()
-                current_questions = paginate_questions(request, selection)
+                # get current page of questions
+                current_questions, total_questions = paginate_questions(
+                    request, Question.query,
+                question_counts.total(session=db.session))
 
                 return jsonify({
                     'success': True,
                     'created': question.id,
                     'question_created': question.question,
                     'questions': current_questions,
-                    'total_questions': len(Question.query.all())
+                    'total_questions': total_questions
                 })
 
+            except QueueFull:
+                abort(503)
             except:
                 # abort unprocessable if error
                 abort(422)
 
+    """
+    Bulk import/export of question packs, streamed as NDJSON or CSV
+    (?format=csv or a text/csv body).
+    """
+    def bulk_format():
+        if (request.args.get('format') == 'csv'
+                or request.mimetype == 'text/csv'):
+            return 'csv'
+        return 'ndjson'
+
+    @app.route('/questions/import', methods=['POST'])
+    @cross_origin()
+    def import_question_pack():
+        parse = parse_csv if bulk_format() == 'csv' else parse_ndjson
+        # queued inserts hold ids the import could take
+        write_queue.flush()
+        imported, errors = import_questions(parse(request.stream))
+
+        # Error if nothing could be imported
+        if not imported and not errors:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'errors': errors,
+            # the import went to the primary
+            'total_questions': question_counts.total(session=db.session)
+        })
+
+    @app.route('/questions/export')
+    @cross_origin()
+    def export_question_pack():
+        file_format = bulk_format()
+        mimetype = ('text/csv' if file_format == 'csv'
+                    else 'application/x-ndjson')
+        return Response(
+            stream_with_context(export_questions(file_format)),
+            mimetype=mimetype,
+            headers={'Content-Disposition':
+                     'attachment; filename=questions.{}'.format(file_format)})
+
+    @app.route('/metrics')
+    def get_metrics():
+        # Prometheus text format
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Creates missing tables and the search index."""
+        init_db()
+        create_search_index()
+        click.echo('database initialised')
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    def import_questions_command(path):
+        """Imports a .ndjson or .csv question pack."""
+        parse = parse_csv if path.endswith('.csv') else parse_ndjson
+        with open(path, encoding='utf-8', newline='') as lines:
+            imported, errors = import_questions(parse(lines))
+        for error in errors:
+            click.echo('line {line}: {message}'.format(**error), err=True)
+        click.echo('imported {} questions'.format(imported))
+
+    @app.cli.command('export-questions')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    def export_questions_command(path):
+        """Exports all questions to a .ndjson or .csv file."""
+        file_format = 'csv' if path.endswith('.csv') else 'ndjson'
+        with open(path, 'w', encoding='utf-8', newline='') as output:
+            for chunk in export_questions(file_format):
+                output.write(chunk)
+
+    @app.cli.command('build-snapshot')
+    @click.argument('path', required=False, type=click.Path(dir_okay=False))
+    def build_snapshot_command(path):
+        """Writes the question snapshot, to SNAPSHOT_PATH by default."""
+        path = path or app.config['SNAPSHOT_PATH']
+        if not path:
+            raise click.UsageError('no path given and SNAPSHOT_PATH unset')
+        click.echo('wrote {} questions to {}'.format(build_snapshot(path), path))
+
     """
     @TODO:
     Create a GET endpoint to get questions based on category.
@@ -241,31 +590,29 @@ def create_app(test_config=None):
     """
     @app.route('/categories/<int:category_id>/questions')
     @cross_origin()
+    @conditional_get
     def get_questions(category_id):
 
-        #Filtering questions under category
-        questions = Question.query.filter(Question.category==category_id)
-
-        formatted_questions = [question.format() for question in questions]                
-
-        # get all categories and add to array
-        categories = Category.query.all()
-        categories_arr = {}
-
-        for category in categories:
-            categories_arr[category.id] = category.type        
-
         #If category not existing
-        if category_id not in categories_arr:
+        if not Category.exists(category_id):
             abort(400)
-        else:
-            return jsonify({
-                'success':True,
-                'questions': formatted_questions,
-                'total_questions': len(formatted_questions),
-                'categories': categories_arr,
-                'current_category':  category_id
-                })
+
+        #Filtering questions under category, one page at a time
+        formatted_questions, total_questions = (
+            snapshot_page(request, category_id) or paginate_questions(
+                request,
+                read_session().query(Question).filter(Question.category==category_id),
+                question_counts.total(category_id)))
+
+        payload = {
+            'success':True,
+            'questions': formatted_questions,
+            'total_questions': total_questions,
+            'current_category':  category_id
+            }
+        if include_categories(request):
+            payload['categories'] = Category.as_dict()
+        return json_response(payload, 'questions')
 
   
     """
@@ -285,43 +632,333 @@ def create_app(test_config=None):
         # load the request body
         body = request.get_json()
         # get the previous questions and category
-        previous_questions = body.get('previous_questions')
+        previous_questions = body.get('previous_questions') or []
         category = body.get('quiz_category')
 
         try:
-            # -- load questions
-            # if category specified 
-            if (category and category['id'] != 0):
-                #Filter out questions not included in previous_questions array
-                questions_raw = (Question.query
-                .filter(Question.category == str(category['id']))
-                .all())
-            #if category not specified
-            else:
-                #Filter out questions not included in previous_questions array
-                questions_raw = (Question.query
-                .filter(Question.id.notin_(previous_questions))
-                .all())   
+            # deck of the category, "All" when not specified
+            category_id = int(category['id']) if category else ALL
+
+            # walk the deck in a fresh random order, skipping the
+            # questions included in previous_questions
+            size, _ = decks.deal(category_id)
+            question, _ = decks.next_question(
+                category_id, new_seed(), 0, size, set(previous_questions))
 
             #If all questions are used, return without question to end game
-            if len(questions_raw) == 0:
+            if question is None:
                 return jsonify({
                     'success': True,
                 })           
 
-            # Format questions & get a random question
-            questions_formatted = [question.format() for question in questions_raw]
-            random_question = random.choice(questions_formatted)
+            return jsonify({
+                'success': True,
+                'question': question,
+                'previous_questions': previous_questions
+            })
 
+        except:
+            # abort unprocessable if error
+            abort(422)
+
+    """
+    Batched quiz: the next `count` distinct questions of a game in one call,
+    with the same previous_questions exclusion as /quizzes
+    """
+    @app.route('/quizzes/batch', methods=['POST'])
+    @cross_origin()
+    def play_quiz_batch():
+        body = request.get_json() or {}
+        previous_questions = body.get('previous_questions') or []
+        category = body.get('quiz_category')
+        count = body.get('count', QUIZ_BATCH_SIZE)
+
+        # Error if the batch size is not a sensible number
+        if (not isinstance(count, int)
+                or not 1 <= count <= MAX_QUIZ_BATCH_SIZE):
+            abort(400)
+
+        try:
+            category_id = int(category['id']) if category else ALL
+
+            # one random order for the whole batch, so no question repeats
+            size, _ = decks.deal(category_id)
+            seed = new_seed()
+            cursor = 0
+            exclude = set(previous_questions)
+            questions = []
+            while len(questions) < count:
+                question, cursor = decks.next_question(
+                    category_id, seed, cursor, size, exclude)
+                if question is None:
+                    break
+                questions.append(question)
+
+            # fewer (or no) questions when the category runs out
             return jsonify({
                 'success': True,
-                'question': random_question,
+                'questions': questions,
                 'previous_questions': previous_questions
             })
 
         except:
             # abort unprocessable if error
             abort(422)
+
+    """
+    Quiz sessions: a game is dealt from the category's deck with its own
+    permutation seed, then each turn only needs the session token.
+    """
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @cross_origin()
+    def start_quiz_session():
+        body = request.get_json() or {}
+        category = body.get('quiz_category')
+        try:
+            category_id = int(category['id']) if category else ALL
+        except (TypeError, KeyError, ValueError):
+            abort(422)
+        player = body.get('player')
+
+        # Error if the player name is not a sensible string
+        if player is not None and (not isinstance(player, str)
+                                   or len(player) > MAX_PLAYER_NAME):
+            abort(400)
+
+        size, total_questions = decks.deal(category_id)
+        token = quiz_sessions.create({
+            'category': category_id,
+            'seed': new_seed(),
+            'cursor': 0,
+            'size': size,
+            # named players make the leaderboard
+            'player': player,
+            'question': None
+        })
+
+        return jsonify({
+            'success': True,
+            'session': token,
+            'total_questions': total_questions
+        })
+
+    @app.route('/quizzes/sessions/<token>', methods=['POST'])
+    @cross_origin()
+    def next_session_question(token):
+        quiz_session = quiz_sessions.get(token)
+
+        # unknown or expired session
+        if quiz_session is None:
+            abort(404)
+
+        # the answer to the previous question, if sent, goes to the stats
+        answer = (request.get_json(silent=True) or {}).get('answer')
+        judged = {'correct': None}
+        if answer is not None and quiz_session.get('question'):
+            previous = decks.question(quiz_session['question'])
+            if previous is not None:
+                correct = correct_answer(previous, answer)
+                quiz_stats.record(previous, correct, quiz_session.get('player'))
+                # the right answer, now that it can't be sent any more
+                judged = {'correct': correct, 'answer': previous['answer']}
+
+        # next question of the game, skipping ones deleted since the deal
+        question, quiz_session['cursor'] = decks.next_question(
+            quiz_session['category'], quiz_session['seed'],
+            quiz_session['cursor'], quiz_session['size'])
+
+        #If all questions are used, return without question to end game
+        if question is None:
+            quiz_sessions.delete(token)
+            return jsonify(dict(judged, success=True))
+
+        quiz_session['question'] = question['id']
+        quiz_sessions.save(token, quiz_session)
+
+        return jsonify(dict(
+            judged,
+            success=True,
+            question=without_answer(question),
+            remaining_questions=quiz_session['size'] - quiz_session['cursor']))
+
+    """
+    Quiz statistics: answers are recorded as they come in and the
+    aggregates are served from memory.
+    """
+    @app.route('/stats/answers', methods=['POST'])
+    @cross_origin()
+    def record_answer():
+        body = request.get_json() or {}
+        question_id = body.get('question_id')
+        answer = body.get('answer')
+
+        # Error if the answer or the question is missing
+        if not isinstance(question_id, int) or not isinstance(answer, str):
+            abort(400)
+
+        question = decks.question(question_id)
+        if question is None:
+            abort(404)
+
+        correct = correct_answer(question, answer)
+        # anonymous: anyone can post any answer here, so only quiz sessions
+        # and rooms feed the leaderboard. They deal each question once and
+        # without its answer, though the question listings still show it
+        quiz_stats.record(question, correct)
+
+        return jsonify({
+            'success': True,
+            'correct': correct,
+            'answer': question['answer']
+        })
+
+    @app.route('/stats')
+    @cross_origin()
+    def get_stats():
+        # ?limit= entries of the leaderboard, ?question_id=1,2 per question
+        limit = int_arg('limit')
+        if limit is not None and not 0 <= limit <= LEADERBOARD_SIZE:
+            abort(400)
+        try:
+            question_ids = [int(question_id) for question_id in
+                            request.args.get('question_id', '').split(',')
+                            if question_id]
+        except ValueError:
+            abort(400)
+
+        payload = dict(quiz_stats.summary(limit), success=True)
+        if question_ids:
+            payload['questions'] = [quiz_stats.question(question_id)
+                                    for question_id in question_ids]
+        return jsonify(payload)
+
+    """
+    Multiplayer rooms: the host creates a room and moves it from question
+    to question, players join, follow it on the event stream and answer.
+    """
+    def require_rooms():
+        # Error if rooms are off (several worker processes)
+        if not app.config['ROOMS']:
+            abort(501)
+
+    def get_room(code):
+        require_rooms()
+        room = rooms.get(code)
+        # unknown or expired room
+        if room is None:
+            abort(404)
+        return room
+
+    @app.route('/rooms', methods=['POST'])
+    @cross_origin()
+    def create_room():
+        require_rooms()
+        body = request.get_json() or {}
+        category = body.get('quiz_category')
+        try:
+            category_id = int(category['id']) if category else ALL
+        except (TypeError, KeyError, ValueError):
+            abort(422)
+
+        # Error if the category doesn't exist
+        if category_id != ALL and not Category.exists(category_id):
+            abort(400)
+
+        room = rooms.create(category_id)
+        return jsonify({
+            'success': True,
+            'room': room.code,
+            'host_token': room.host_token,
+            'total_questions': room.size
+        })
+
+    @app.route('/rooms/<code>/players', methods=['POST'])
+    @cross_origin()
+    def join_room(code):
+        room = get_room(code)
+        name = (request.get_json() or {}).get('name')
+
+        # Error if the name is missing or too long
+        if (not isinstance(name, str) or not name.strip()
+                or len(name) > MAX_PLAYER_NAME):
+            abort(400)
+
+        token = room.join(name.strip())
+        # Error if the name is taken
+        if token is None:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'room': room.code,
+            'player_token': token
+        })
+
+    @app.route('/rooms/<code>/events')
+    @cross_origin()
+    def room_events(code):
+        room = get_room(code)
+        # a reconnecting EventSource resumes after the last event it got
+        last_event = request.headers.get(
+            'Last-Event-ID', request.args.get('last_event_id', 0))
+        try:
+            last_event = int(last_event)
+        except ValueError:
+            abort(400)
+
+        # under asgi.py (ASYNC_BODY), streamed by the event loop instead
+        request.environ['trivia.async_body'] = room.async_events(
+            last_event, app.config['ROOM_KEEPALIVE'])
+        return Response(
+            room.events(last_event, app.config['ROOM_KEEPALIVE']),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+
+    @app.route('/rooms/<code>/next', methods=['POST'])
+    @cross_origin()
+    def next_room_question(code):
+        room = get_room(code)
+        # only the host moves the game on
+        if (request.get_json() or {}).get('host_token') != room.host_token:
+            abort(403)
+
+        question = room.next()
+
+        #If all questions are used, the game is over
+        if question is None:
+            return jsonify({
+                'success': True,
+                'finished': True,
+                'scores': room.scores
+            })
+
+        return jsonify({
+            'success': True,
+            'question': question,
+            'number': room.number
+        })
+
+    @app.route('/rooms/<code>/answers', methods=['POST'])
+    @cross_origin()
+    def answer_room_question(code):
+        room = get_room(code)
+        body = request.get_json() or {}
+        answer = body.get('answer')
+
+        # Error if there is no answer to record
+        if not isinstance(answer, str):
+            abort(400)
+
+        # Error if the player is unknown, already answered, or the game
+        # hasn't started or has moved past the question (`number`)
+        if not room.answer(body.get('player_token'), answer, body.get('number')):
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'number': room.number
+        })
   
     """
     @TODO:
@@ -337,6 +974,14 @@ def create_app(test_config=None):
             "message":"bad request"
         }), 400
   
+    @app.errorhandler(403)
+    def forbidden(error): #not the room's host
+        return jsonify({
+            "success": False,
+            "error":403,
+            "message":"forbidden"
+        }), 403
+
     @app.errorhandler(404)
     def not_found(error): #page not found
         return jsonify({
@@ -353,6 +998,22 @@ def create_app(test_config=None):
             "message":"unprocessable"
         }), 422
 
+    @app.errorhandler(501)
+    def not_implemented(error): #rooms off in a multi-process server
+        return jsonify({
+            "success": False,
+            "error":501,
+            "message":"not implemented"
+        }), 501
+
+    @app.errorhandler(503)
+    def unavailable(error): #write queue full
+        return jsonify({
+            "success": False,
+            "error":503,
+            "message":"service unavailable"
+        }), 503, {'Retry-After': '1'}
+
     @app.errorhandler(500)
     def unexpected(error): 
         return jsonify({
@@ -361,7 +1022,4 @@ def create_app(test_config=None):
             "message":"Unexpected condition"
         }), 500
 
-    if __name__ == '__main__':
-        app.run(debug=True)
-
     return app
@@ -0,0 +1,116 @@
+"""
+Response compression
+
+Compresses JSON and text responses of COMPRESS_MIN_SIZE bytes or more
+with brotli (when the `brotli` package is installed and the client accepts
+it) or gzip, as negotiated through Accept-Encoding. Streamed responses (of
+unknown size) are compressed chunk by chunk as they are sent; 304s are sent
+as they are. A compressed response's ETag gets the encoding appended, so
+each representation has its own validator. Compressed bodies of responses
+with an ETag are kept for HTTP_BODY_CACHE_TTL seconds, so cached pages
+aren't compressed on every request.
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+from .http_cache import BodyCache, encoded_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESSED_MIMETYPES = {'application/json', 'application/x-ndjson',
+                        'text/csv', 'text/plain', 'text/html'}
+
+compressed_cache = BodyCache()
+
+
+def choose_encoding():
+    # the encoding the client prefers, brotli on a tie
+    accepted = request.accept_encodings
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = max(candidates, key=lambda name: accepted[name])
+    return encoding if accepted[encoding] > 0 else None
+
+
+def compress_body(data, encoding, level):
+    if encoding == 'br':
+        # brotli quality runs 0-11, gzip levels 1-9
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_chunks(chunks, encoding, level):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(level, 11))
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31: a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        # the compressor buffers small chunks until it has a block
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def encoded(response, encoding, etag, weak):
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+"""
+compress_responses(app)
+    registers the after_request hook compressing `app`'s responses
+"""
+def compress_responses(app):
+
+    @app.after_request
+    def compress_response(response):
+        min_size = app.config['COMPRESS_MIN_SIZE']
+        if (not min_size
+                or response.status_code != 200
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSED_MIMETYPES):
+            return response
+
+        # caches must keep one copy per encoding
+        response.vary.add('Accept-Encoding')
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            response.response = compress_chunks(
+                response.iter_encoded(), encoding, app.config['COMPRESS_LEVEL'])
+            response.headers.pop('Content-Length', None)
+            return encoded(response, encoding, etag, weak)
+
+        ttl = app.config['HTTP_BODY_CACHE_TTL']
+        key = '{}|{}'.format(etag, encoding)
+        body = compressed_cache.get(key) if etag and ttl else None
+        if body is None:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            body = compress_body(data, encoding, app.config['COMPRESS_LEVEL'])
+            if etag and ttl:
+                compressed_cache.set(key, body, ttl)
+
+        response.set_data(body)
+        return encoded(response, encoding, etag, weak)
@@ -0,0 +1,73 @@
+"""
+Fast JSON responses
+
+FastJSONEncoder is installed as the app's JSON encoder and encodes with
+orjson when it is installed (`pip install orjson`), falling back to the
+standard library otherwise. json_response() streams long question arrays
+a chunk at a time instead of building the whole body first. Either way the
+JSON sent is the same document jsonify() would send.
+"""
+
+from flask import current_app, jsonify, json, Response, stream_with_context
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# arrays longer than this are streamed, STREAM_CHUNK items at a time
+STREAM_THRESHOLD = 100
+STREAM_CHUNK = 100
+
+
+class FastJSONEncoder(JSONEncoder):
+
+    def encode(self, o):
+        # orjson writes compact json only
+        if orjson is not None and self.indent is None:
+            option = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(o, default=self.default,
+                                    option=option).decode('utf-8')
+            except TypeError:
+                # e.g. integers over 64 bits, left to the standard library
+                pass
+        return super().encode(o)
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def stream_object(payload, key):
+    # same key order as jsonify
+    names = (sorted(payload) if current_app.config['JSON_SORT_KEYS']
+             else list(payload))
+    items = payload[key]
+    yield '{'
+    for position, name in enumerate(names):
+        yield '{}{}:'.format(',' if position else '', dumps(name))
+        if name != key:
+            yield dumps(payload[name])
+            continue
+        yield '['
+        for start in range(0, len(items), STREAM_CHUNK):
+            chunk = dumps(items[start:start + STREAM_CHUNK])[1:-1]
+            yield ',' + chunk if start else chunk
+        yield ']'
+    yield '}\n'
+
+
+"""
+json_response(payload, key)
+    jsonify(payload), streamed when the array payload[key] is long
+"""
+def json_response(payload, key):
+    if len(payload[key]) <= STREAM_THRESHOLD:
+        return jsonify(payload)
+    return Response(stream_with_context(stream_object(payload, key)),
+                    mimetype=current_app.config['JSONIFY_MIMETYPE'])
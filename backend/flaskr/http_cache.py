@@ -0,0 +1,186 @@
+"""
+HTTP caching for the read endpoints
+
+Responses get an ETag and Last-Modified derived from a data version that is
+bumped by Question.insert/update/delete (and category reloads), so repeated
+page loads are answered with 304 Not Modified without touching the database
+or serialising anything. Serialised 200 bodies can also be kept in process
+for HTTP_BODY_CACHE_TTL seconds, keyed by path and data version.
+
+The version lives in this process unless HTTP_VERSION_PATH names a file
+shared by the worker processes (serve.py makes one with several workers):
+a change then grows the file by a byte, and every worker reads the
+version from its size, one stat() per request. Workers on other hosts
+don't share it.
+"""
+
+import calendar
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+from models import Category, on_question_change
+
+
+HTTP_CACHE_MAX_AGE = 0
+HTTP_BODY_CACHE_TTL = 10
+HTTP_BODY_CACHE_SIZE = 256
+# Content-Encodings compression.py may send, each with its own ETag
+ETAG_ENCODINGS = ('gzip', 'br')
+
+
+class DataVersion:
+
+    def __init__(self, path=None):
+        # ETags from an earlier run never match
+        self.boot = uuid.uuid4().hex[:8]
+        self.path = path
+        self.questions = 0
+        # whole seconds, as sent in Last-Modified
+        self.modified = int(time.time())
+
+    def start(self, path):
+        """Shares the version through the file at `path`, None for none."""
+        self.path = path
+        if path and not os.path.exists(path):
+            self.bump()
+
+    def bump(self, action=None, question=None):
+        self.questions += 1
+        self.modified = int(time.time())
+        if self.path:
+            # appends are atomic, so concurrent bumps each grow the file
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, b'.')
+            finally:
+                os.close(fd)
+
+    def current(self):
+        # load the categories first so a reload doesn't change the version
+        # halfway through a request
+        Category.cache.get()
+        questions = self.questions
+        if self.path:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                pass
+            else:
+                questions = stat.st_size
+                self.modified = int(stat.st_mtime)
+        return '{}-{}-{}'.format(self.boot, questions, Category.cache.version)
+
+
+data_version = DataVersion()
+on_question_change(data_version.bump)
+
+
+"""
+BodyCache
+    small LRU of serialised response bodies with a time to live
+"""
+class BodyCache:
+
+    def __init__(self, size=HTTP_BODY_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._bodies.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._bodies.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, body, ttl):
+        with self._lock:
+            self._bodies[key] = (time.time() + ttl, body)
+            self._bodies.move_to_end(key)
+            while len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._bodies)
+        }
+
+
+body_cache = BodyCache()
+
+
+def encoded_etag(etag, encoding):
+    # strong validators differ per representation
+    return '{}-{}'.format(etag, encoding)
+
+
+def not_modified(etag, last_modified):
+    """The ETag of the representation the client holds, None if it is stale."""
+    if request.if_none_match:
+        for tag in [etag] + [encoded_etag(etag, encoding)
+                             for encoding in ETAG_ENCODINGS]:
+            if request.if_none_match.contains(tag):
+                return tag
+        return None
+    since = request.if_modified_since
+    if (since is not None
+            and calendar.timegm(since.utctimetuple()) >= last_modified):
+        return etag
+    return None
+
+
+"""
+conditional_get
+    view decorator adding ETag/Last-Modified/Cache-Control and answering
+    If-None-Match / If-Modified-Since with 304
+"""
+def conditional_get(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # read the data version first, so a change while the view runs
+        # can't be cached under the old version
+        version = data_version.current()
+        last_modified = data_version.modified
+        key = '{}|{}'.format(version, request.full_path)
+        etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        held = not_modified(etag, last_modified)
+        if held:
+            response = current_app.response_class(status=304)
+            # compression.py leaves 304s as they are
+            etag = held
+        else:
+            ttl = current_app.config['HTTP_BODY_CACHE_TTL']
+            cached = body_cache.get(key) if ttl else None
+            if cached is not None:
+                response = current_app.response_class(
+                    cached[0], mimetype=cached[1])
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                # streamed bodies aren't buffered
+                if (ttl and response.status_code == 200
+                        and not response.is_streamed):
+                    body_cache.set(key, (response.get_data(), response.mimetype), ttl)
+
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+            response.cache_control.must_revalidate = True
+        return response
+    return wrapper
@@ -0,0 +1,328 @@
+"""
+Request instrumentation
+
+Records, per route and method: request count by status, latency, number of
+SQL queries, time spent in SQL and time spent serialising JSON. Figures are
+exposed in the Prometheus text format on /metrics and, with SERVER_TIMING
+on, as a Server-Timing header on every response (visible in the browser's
+network panel).
+
+With PROFILE_SLOW_MS set, a sampling profiler records the stacks of the
+threads serving requests every PROFILE_INTERVAL_MS, and requests slower
+than PROFILE_SLOW_MS are written to PROFILE_DIR in the folded format read
+by flamegraph.pl and speedscope.
+
+Figures live in this process; each worker reports its own.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import Category
+from write_queue import write_queue
+from .http_cache import body_cache
+from .fast_json import FastJSONEncoder
+
+
+# upper bounds of the latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+PROFILE_INTERVAL_MS = 5
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'trivia-profiles')
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+
+def current_stats():
+    # None outside requests, e.g. CLI commands or startup
+    if has_app_context():
+        return g.get('request_stats')
+    return None
+
+
+"""
+SQL timing, for every engine (primary and replica)
+"""
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+"""
+TimedJSONEncoder
+    the app's encoder, timing each jsonify() into the request's stats
+"""
+class TimedJSONEncoder(FastJSONEncoder):
+
+    def encode(self, o):
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.serialize_seconds += time.perf_counter() - started
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.statuses = Counter()
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+    def add(self, status, seconds, stats):
+        self.statuses[status] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.queries += stats.queries
+        self.sql_seconds += stats.sql_seconds
+        self.serialize_seconds += stats.serialize_seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+
+"""
+Metrics
+    per (route, method) totals, rendered in the Prometheus text format
+"""
+class Metrics:
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, method, status, seconds, stats):
+        with self._lock:
+            metrics = self.routes.get((route, method))
+            if metrics is None:
+                metrics = self.routes[(route, method)] = RouteMetrics()
+            metrics.add(status, seconds, stats)
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        with self._lock:
+            routes = sorted(self.routes.items())
+            metric('trivia_requests_total', 'counter', 'Requests served.',
+                   [(dict(route=route, method=method, status=status), count)
+                    for (route, method), metrics in routes
+                    for status, count in sorted(metrics.statuses.items())])
+
+            histogram = []
+            for (route, method), metrics in routes:
+                labels = dict(route=route, method=method)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    cumulative += count
+                    histogram.append((dict(labels, le=bound), cumulative))
+                histogram.append((dict(labels, le='+Inf'), metrics.count))
+            lines.append('# HELP trivia_request_duration_seconds Request latency.')
+            lines.append('# TYPE trivia_request_duration_seconds histogram')
+            for labels, value in histogram:
+                lines.append('trivia_request_duration_seconds_bucket{} {}'.format(
+                    format_labels(labels), value))
+            for (route, method), metrics in routes:
+                labels = format_labels(dict(route=route, method=method))
+                lines.append('trivia_request_duration_seconds_sum{} {}'.format(
+                    labels, metrics.seconds))
+                lines.append('trivia_request_duration_seconds_count{} {}'.format(
+                    labels, metrics.count))
+
+            for name, attribute, help_text in (
+                    ('trivia_sql_queries_total', 'queries', 'SQL statements run.'),
+                    ('trivia_sql_seconds_total', 'sql_seconds', 'Time spent in SQL.'),
+                    ('trivia_serialize_seconds_total', 'serialize_seconds',
+                     'Time spent encoding JSON.')):
+                metric(name, 'counter', help_text,
+                       [(dict(route=route, method=method), getattr(metrics, attribute))
+                        for (route, method), metrics in routes])
+
+        categories = Category.cache.stats()
+        metric('trivia_category_cache_hits_total', 'counter',
+               'Category cache hits.', [({}, categories['hits'])])
+        metric('trivia_category_cache_misses_total', 'counter',
+               'Category cache reloads.', [({}, categories['misses'])])
+        bodies = body_cache.stats()
+        metric('trivia_body_cache_hits_total', 'counter',
+               'Cached response bodies served.', [({}, bodies['hits'])])
+        metric('trivia_body_cache_misses_total', 'counter',
+               'Response bodies not in the cache.', [({}, bodies['misses'])])
+        metric('trivia_body_cache_entries', 'gauge',
+               'Response bodies cached.', [({}, bodies['entries'])])
+        if write_queue.running:
+            writes = write_queue.stats()
+            for name, kind, key, help_text in (
+                    ('queued_total', 'counter', 'queued', 'Writes queued.'),
+                    ('flushed_total', 'counter', 'flushed', 'Writes committed.'),
+                    ('failed_total', 'counter', 'failed', 'Writes dropped after an error.'),
+                    ('batches_total', 'counter', 'batches', 'Batches flushed.'),
+                    ('flush_seconds_total', 'counter', 'flush_seconds',
+                     'Time spent committing batches.'),
+                    ('flush_seconds_max', 'gauge', 'max_flush_seconds',
+                     'Slowest batch commit.'),
+                    ('backpressure_waits_total', 'counter', 'waits',
+                     'Writers that waited for room in the queue.'),
+                    ('rejected_total', 'counter', 'rejected',
+                     'Writers turned away with the queue full.'),
+                    ('depth', 'gauge', 'depth', 'Writes waiting to be flushed.')):
+                metric('trivia_write_behind_' + name, kind, help_text,
+                       [({}, writes[key])])
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())) + '}'
+
+
+metrics = Metrics()
+
+
+"""
+SamplingProfiler(interval)
+    samples the stacks of the threads registered with start() every
+    `interval` seconds, from one background thread
+"""
+class SamplingProfiler:
+
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            self._samples[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='trivia-profiler')
+                self._thread.start()
+
+    def stop(self):
+        """Returns the folded stack counts of the calling thread."""
+        with self._lock:
+            return self._samples.pop(threading.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._samples.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[fold(frame)] += 1
+
+
+def fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name,
+                                          os.path.basename(code.co_filename),
+                                          frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+profiler = SamplingProfiler()
+
+
+def dump_profile(samples, route, method, seconds, directory):
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}-{}-{}ms.folded'.format(
+        int(time.time() * 1000), method,
+        route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root',
+        int(seconds * 1000))
+    with open(os.path.join(directory, name), 'w') as output:
+        for stack, count in samples.items():
+            output.write('{} {}\n'.format(stack, count))
+
+
+"""
+instrument(app)
+    installs the timing hooks and JSON encoder on `app`. Register it before
+    the other after_request hooks so it runs last and times them too.
+"""
+def instrument(app):
+    app.json_encoder = TimedJSONEncoder
+    profiler.interval = app.config['PROFILE_INTERVAL_MS'] / 1000
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+        if app.config['PROFILE_SLOW_MS']:
+            profiler.start()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        seconds = time.perf_counter() - stats.start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.record(route, request.method, response.status_code, seconds, stats)
+
+        if app.config['PROFILE_SLOW_MS']:
+            samples = profiler.stop()
+            if samples and seconds * 1000 >= app.config['PROFILE_SLOW_MS']:
+                dump_profile(samples, route, request.method, seconds,
+                             app.config['PROFILE_DIR'])
+
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                'db;dur={:.2f};desc="{} queries", serialize;dur={:.2f}, '
+                'total;dur={:.2f}'.format(
+                    stats.sql_seconds * 1000, stats.queries,
+                    stats.serialize_seconds * 1000, seconds * 1000))
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exception=None):
+        # no-op unless after_request was skipped
+        if app.config['PROFILE_SLOW_MS']:
+            profiler.stop()
@@ -0,0 +1,78 @@
+"""
+Schema upgrade for existing trivia databases
+
+Older databases created from the models (rather than trivia.psql) store
+questions.category as text. This turns it into an integer foreign key to
+categories.id and adds the indexes used by the category listing, the
+quiz and the GET /questions filters: (category, id), difficulty and
+(category, difficulty, id).
+Legacy categories that aren't a number lose their category, as do
+those pointing at a missing category. Safe to run more than once.
+
+    python migrate.py [database_url]
+
+The database url defaults to the one built from DB_NAME/DB_USER/DB_PASSWORD.
+"""
+
+import sys
+
+from sqlalchemy import create_engine, inspect
+
+from models import database_path
+
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+    'ON questions (category, id)',
+    'CREATE INDEX IF NOT EXISTS ix_questions_difficulty '
+    'ON questions (difficulty)',
+    'CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty '
+    'ON questions (category, difficulty, id)',
+]
+
+# anything but a plain number (at most 9 digits, so it fits an integer)
+# becomes NULL instead of failing the cast and the whole migration
+POSTGRES_CATEGORY_TYPE = (
+    'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+    r"USING CASE WHEN category::text ~ '^\s*\d{1,9}\s*$' "
+    'THEN trim(category::text)::integer END'
+)
+
+POSTGRES_CATEGORY_FOREIGN_KEY = (
+    'ALTER TABLE questions ADD CONSTRAINT category '
+    'FOREIGN KEY (category) REFERENCES categories (id) '
+    'ON UPDATE CASCADE ON DELETE SET NULL'
+)
+
+
+"""
+upgrade(bind)
+    upgrades the questions table of an engine, or of a connection within
+    its current transaction
+"""
+def upgrade(bind):
+    inspector = inspect(bind)
+    columns = {column['name']: column for column in inspector.get_columns('questions')}
+    foreign_keys = inspector.get_foreign_keys('questions')
+
+    with bind.connect() as connection, connection.begin():
+        if bind.dialect.name == 'postgresql':
+            if columns['category']['type'].python_type is not int:
+                # questions pointing at missing categories lose their category,
+                # as they would with the foreign key's ON DELETE SET NULL
+                connection.execute(POSTGRES_CATEGORY_TYPE)
+                connection.execute(
+                    'UPDATE questions SET category = NULL WHERE category '
+                    'NOT IN (SELECT id FROM categories)')
+            if not any(key['referred_table'] == 'categories'
+                       for key in foreign_keys):
+                connection.execute(POSTGRES_CATEGORY_FOREIGN_KEY)
+
+        for statement in INDEXES:
+            connection.execute(statement)
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 else database_path
+    upgrade(create_engine(url))
+    print('questions schema is up to date')
@@ -1,8 +1,11 @@
 import os
-import dotenv
-from sqlalchemy import Column, String, Integer, create_engine
+import re
+import logging
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, text
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-import json
+
+from category_cache import CategoryCache
 
 
 #setting up secrets from virtual environment
@@ -11,19 +14,116 @@ database_user = os.getenv("DB_USER")
 database_password = os.getenv("DB_PASSWORD")
 
 
-database_path = 'postgresql://{}:{}@{}/{}'.format(database_user, database_password,'localhost:5432', database_name)
+# DATABASE_URL, when set, replaces the local PostgreSQL database
+database_path = os.getenv('DATABASE_URL') or 'postgresql://{}:{}@{}/{}'.format(database_user, database_password,'localhost:5432', database_name)
+
+# connection pool and engine tuning, overridable through app.config
+DATABASE_DEFAULTS = {
+    'DB_POOL_SIZE': int(os.getenv('DB_POOL_SIZE', 5)),
+    'DB_MAX_OVERFLOW': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+    'DB_POOL_PRE_PING': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    # seconds before a pooled connection is replaced, -1 to keep forever
+    'DB_POOL_RECYCLE': int(os.getenv('DB_POOL_RECYCLE', 30 * 60)),
+    # milliseconds, 0 for no limit (PostgreSQL only)
+    'DB_STATEMENT_TIMEOUT': int(os.getenv('DB_STATEMENT_TIMEOUT', 0)),
+    # optional read replica used by the GET routes
+    'DB_REPLICA_URL': os.getenv('DB_REPLICA_URL'),
+    # extra create_engine() arguments, e.g. the tests' connection creator
+    'DB_ENGINE_OPTIONS': None,
+}
 
 db = SQLAlchemy()
 
+"""
+on_question_change(listener)
+    registers listener(action, question), called after a question change
+    is committed. action is 'insert', 'update' or 'delete', or 'reset' (with
+    question None) when the whole table may have changed, e.g. after binding
+    a different database. A listener that raises is logged and skipped: the
+    change is committed by then.
+"""
+question_listeners = []
+log = logging.getLogger(__name__)
+
+def on_question_change(listener):
+    question_listeners.append(listener)
+    return listener
+
+def notify_question_change(action, question=None):
+    for listener in question_listeners:
+        try:
+            listener(action, question)
+        except Exception:
+            log.exception('question %s listener %r failed', action, listener)
+
+"""
+engine_options(config, database_path)
+    SQLAlchemy engine options built from the DB_* settings
+"""
+def engine_options(config, database_path):
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    # SQLite doesn't use a sized connection pool
+    if not database_path.startswith('sqlite'):
+        options.update({
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+        })
+    if config['DB_STATEMENT_TIMEOUT'] and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(
+                config['DB_STATEMENT_TIMEOUT'])
+        }
+    # explicit options win, e.g. the tests' connection creator and pool
+    options.update(config.get('DB_ENGINE_OPTIONS') or {})
+    return options
+
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    Tables aren't created here; run `flask init-db` (or load trivia.psql)
+    once when setting up a new database.
 """
 def setup_db(app, database_path=database_path):
+    for key, value in DATABASE_DEFAULTS.items():
+        app.config.setdefault(key, value)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config,
+                                                             database_path)
+    replica_url = app.config['DB_REPLICA_URL']
+    if replica_url:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': replica_url}
     db.app = app
     db.init_app(app)
+
+    if replica_url:
+        # no per-table binds (Flask-SQLAlchemy maps every table to the
+        # primary), so the models resolve to the session's bind: the replica
+        app.extensions['replica_session'] = db.create_scoped_session(
+            options={'bind': db.get_engine(app, bind='replica'), 'binds': {}})
+        app.teardown_appcontext(remove_replica_session)
+
+    # a new database may hold different categories and questions
+    Category.cache.invalidate()
+    notify_question_change('reset')
+
+def remove_replica_session(exception=None):
+    current_app.extensions['replica_session'].remove()
+
+"""
+read_session()
+    session for the read-only GET routes: the replica when DB_REPLICA_URL is
+    set, db.session otherwise
+"""
+def read_session():
+    return current_app.extensions.get('replica_session', db.session)
+
+"""
+init_db()
+    creates missing tables, within an app context
+"""
+def init_db():
     db.create_all()
 
 """
@@ -32,11 +132,20 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # category listing and quiz filtering are index scans on (category, id),
+    # difficulty filters and sorts on the difficulty indexes
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id',
+                                          onupdate='CASCADE',
+                                          ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -48,13 +157,16 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_question_change('insert', self)
 
     def update(self):
         db.session.commit()
+        notify_question_change('update', self)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', self)
 
     def format(self):
         return {
@@ -65,6 +177,17 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+"""
+question_columns / format_question_row(row)
+    the read paths select these columns as plain tuples, skipping ORM
+    objects, and format them into the same dict as Question.format()
+"""
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+question_columns = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+def format_question_row(row):
+    return dict(zip(QUESTION_FIELDS, row))
+
 """
 Category
 
@@ -82,4 +205,65 @@ class Category(db.Model):
         return {
             'id': self.id,
             'type': self.type
-            }
\ No newline at end of file
+            }
+
+    """
+    Cached {id: type} map of all categories, as sent to the frontend
+    """
+    @classmethod
+    def as_dict(cls):
+        return cls.cache.get()
+
+    @classmethod
+    def exists(cls, category_id):
+        return cls.cache.exists(category_id)
+
+
+def load_categories():
+    return {category.id: category.type
+            for category in Category.query.order_by(Category.id)}
+
+Category.cache = CategoryCache(load_categories)
+
+"""
+load_fixture(path)
+    inserts the COPY blocks of a pg_dump file such as trivia.psql into the
+    categories and questions tables, within an app context. Returns the
+    number of rows per table.
+"""
+COPY_BLOCK = re.compile(r'^COPY public\.(\w+) \(([^)]*)\) FROM stdin;\n(.*?)^\\\.$',
+                        re.MULTILINE | re.DOTALL)
+COPY_ESCAPES = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+
+def copy_value(value, column):
+    if value == '\\N':
+        return None
+    value = re.sub(r'\\[\\tnr]', lambda match: COPY_ESCAPES[match.group()], value)
+    return int(value) if isinstance(column.type, Integer) else value
+
+def load_fixture(path):
+    with open(path, encoding='utf-8') as dump:
+        blocks = {match.group(1): match for match in COPY_BLOCK.finditer(dump.read())}
+    counts = {}
+    # categories first, questions reference them
+    for table in (Category.__table__, Question.__table__):
+        match = blocks.get(table.name)
+        if match is None:
+            continue
+        columns = [table.c[name.strip()] for name in match.group(2).split(',')]
+        rows = [{column.key: copy_value(value, column)
+                 for column, value in zip(columns, line.split('\t'))}
+                for line in match.group(3).splitlines()]
+        if rows:
+            db.session.execute(table.insert(), rows)
+            if db.engine.dialect.name == 'postgresql':
+                # explicit ids leave the sequence behind
+                db.session.execute(text(
+                    "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                    "(SELECT max(id) FROM {}))".format(table.name)),
+                    {'table': table.name})
+        counts[table.name] = len(rows)
+    db.session.commit()
+    notify_question_change('reset')
+    Category.cache.invalidate()
+    return counts
@@ -0,0 +1,91 @@
+"""
+Question counts
+
+Totals for the `total_questions` field of the responses, from a
+`SELECT count(*)` instead of hydrating every row.
+With `cached` on, the per-category counts are loaded with one GROUP BY query
+and then kept up to date in memory on Question.insert/delete, and reloaded
+every `ttl` seconds to pick up changes made by other workers.
+The counts are read through read_session(), like the listings they are
+the totals of, so both come from the replica when one is set.
+"""
+
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import read_session, Question, on_question_change
+
+
+QUESTION_COUNTS_TTL = 60
+
+
+def count_questions(category=None, session=None):
+    selection = (session or read_session()).query(func.count(Question.id))
+    if category is not None:
+        selection = selection.filter(Question.category == category)
+    return selection.scalar()
+
+
+class QuestionCounts:
+
+    def __init__(self, cached=True, ttl=QUESTION_COUNTS_TTL):
+        self.cached = cached
+        self.ttl = ttl
+        self._counts = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self, session):
+        # called with the lock held
+        if self._counts is None or time.time() >= self._expires_at:
+            rows = (session
+                    .query(Question.category, func.count(Question.id))
+                    .group_by(Question.category))
+            self._counts = {key(category): count for category, count in rows}
+            self._expires_at = time.time() + self.ttl
+        return self._counts
+
+    def total(self, category=None, session=None):
+        """
+        Number of questions, in `category` if given, as seen by `session`
+        (read_session() by default). Only the read session is cached.
+        """
+        if session is None:
+            session = read_session()
+        if not self.cached or session is not read_session():
+            return count_questions(category, session)
+        # listeners change the counts meanwhile
+        with self._lock:
+            counts = self._load(session)
+            if category is None:
+                return sum(counts.values())
+            return counts.get(key(category), 0)
+
+    def question_changed(self, action, question):
+        with self._lock:
+            if self._counts is None:
+                return
+            if action == 'insert':
+                category = key(question.category)
+                self._counts[category] = self._counts.get(category, 0) + 1
+            elif action == 'delete':
+                category = key(question.category)
+                self._counts[category] = max(self._counts.get(category, 0) - 1, 0)
+            else:
+                # the category of an updated question may have changed
+                self._counts = None
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = None
+
+
+def key(category):
+    # categories may come back as strings or ints depending on the column
+    return None if category is None else int(category)
+
+
+question_counts = QuestionCounts()
+on_question_change(question_counts.question_changed)
@@ -0,0 +1,140 @@
+"""
+Quiz session stores
+
+A quiz session holds the category, permutation seed and cursor of one game
+(see decks.py), so a client only sends its session token every turn
+instead of the ever-growing previous_questions array.
+Sessions are plain json-serialisable dicts and expire `ttl` seconds after
+they were last touched.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+SESSION_TTL = 60 * 60
+
+
+def new_token():
+    return uuid.uuid4().hex
+
+
+"""
+MemorySessionStore
+    sessions of this process only, the default for a single worker
+"""
+class MemorySessionStore:
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        # token -> (expires_at, session), oldest touch first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, session):
+        token = new_token()
+        self.save(token, session)
+        return token
+
+    def get(self, token):
+        with self._lock:
+            self._evict_expired()
+            entry = self._sessions.get(token)
+            return None if entry is None else entry[1]
+
+    def save(self, token, session):
+        with self._lock:
+            self._evict_expired()
+            self._sessions[token] = (time.time() + self.ttl, session)
+            self._sessions.move_to_end(token)
+
+    def delete(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def _evict_expired(self):
+        # entries are kept in touch order, so expired ones are at the front
+        now = time.time()
+        while self._sessions:
+            token, (expires_at, _) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[token]
+
+
+"""
+SqliteSessionStore
+    sessions in a local SQLite file, shared by every worker process on the
+    host. A local stand-in for a networked store such as Redis.
+"""
+class SqliteSessionStore:
+
+    def __init__(self, path, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS quiz_sessions ('
+                               'token TEXT PRIMARY KEY, '
+                               'expires_at REAL NOT NULL, '
+                               'data TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS '
+                               'ix_quiz_sessions_expires_at '
+                               'ON quiz_sessions (expires_at)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # only imported when this store is used
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def create(self, session):
+        token = new_token()
+        with self._connection() as connection:
+            connection.execute('DELETE FROM quiz_sessions WHERE expires_at <= ?',
+                               (time.time(),))
+        self.save(token, session)
+        return token
+
+    def get(self, token):
+        row = self._connection().execute(
+            'SELECT data FROM quiz_sessions WHERE token = ? AND expires_at > ?',
+            (token, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save(self, token, session):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO quiz_sessions (token, expires_at, data) '
+                'VALUES (?, ?, ?)',
+                (token, time.time() + self.ttl, json.dumps(session)))
+
+    def delete(self, token):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM quiz_sessions WHERE token = ?',
+                               (token,))
+
+
+"""
+make_session_store(uri, ttl)
+    'memory' for MemorySessionStore, 'sqlite:///<path>' for SqliteSessionStore
+"""
+def make_session_store(uri='memory', ttl=SESSION_TTL):
+    if not uri or uri == 'memory':
+        return MemorySessionStore(ttl)
+    if uri.startswith('sqlite:///'):
+        path = uri[len('sqlite:///'):]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SqliteSessionStore(path, ttl)
+    raise ValueError('Unknown quiz session store: {}'.format(uri))
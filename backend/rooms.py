@@ -0,0 +1,270 @@
+"""
+Quiz rooms
+
+A room is one game played by many players at once. The host creates it for
+a category and moves it from question to question; players join, follow
+the game over Server-Sent Events and send their answers.
+
+The room walks the category's deck (see decks.py) once for everybody, so a
+question costs one deck lookup per room whatever the number of players, and
+every event is serialised once and written as the same bytes to each
+subscriber. Events are kept in a per-room log with increasing ids, so a
+subscriber that reconnects with Last-Event-ID picks up where it left off.
+
+Events:
+    question    the question of the turn, without its answer
+    results     the answer of the turn just played, who got it right and
+                the scores so far
+    end         the final scores, after which the stream closes
+
+The answers of each turn are recorded in the quiz statistics (stats.py).
+
+Under asgi.py the streams are served by async_events() on the event loop,
+woken by the room, so subscribers hold no thread.
+
+Rooms live in this process only: they need a single worker process, and
+serve.py turns them off when it runs more.
+"""
+
+import json
+import random
+import string
+import threading
+import time
+
+from decks import decks, new_seed, without_answer
+from quiz_sessions import new_token
+from stats import quiz_stats, normalise_answer
+
+
+ROOM_TTL = 2 * 60 * 60
+# seconds between keep-alive comments on an idle event stream
+ROOM_KEEPALIVE = 15
+# events kept for reconnecting subscribers
+ROOM_EVENT_LOG = 100
+ROOM_CODE_LENGTH = 6
+MAX_PLAYER_NAME = 40
+
+
+def format_event(event_id, event, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event_id, event, json.dumps(data, separators=(',', ':')))
+
+
+def new_code():
+    return ''.join(random.choice(string.ascii_uppercase + string.digits)
+                   for _ in range(ROOM_CODE_LENGTH))
+
+
+class Room:
+
+    def __init__(self, category):
+        self.code = None
+        self.category = category
+        self.host_token = new_token()
+        # the game's walk through the category deck
+        self.seed = new_seed()
+        self.size, _ = decks.deal(category)
+        self.cursor = 0
+        self.number = 0
+        self.question = None
+        # player token -> name, and name -> score
+        self.players = {}
+        self.scores = {}
+        # player token -> answer to the current question
+        self.answers = {}
+        self.finished = False
+        self.touched_at = time.time()
+        self._events = []
+        self._last_event = 0
+        self._changed = threading.Condition()
+        # (loop, asyncio.Event) of the async subscribers waiting for events
+        self._waiters = set()
+        # one turn dealt at a time
+        self._turn = threading.Lock()
+
+    def join(self, name):
+        """Adds a player, returns their token. Names are unique per room."""
+        with self._changed:
+            if name in self.scores:
+                return None
+            token = new_token()
+            self.players[token] = name
+            self.scores[name] = 0
+            self.touched_at = time.time()
+            return token
+
+    def answer(self, player_token, answer, number=None):
+        """
+        Records a player's answer to the current question, once. With
+        `number`, answers to a question that is no longer current are
+        refused.
+        """
+        with self._changed:
+            if (player_token not in self.players or self.question is None
+                    or player_token in self.answers
+                    or number not in (None, self.number)):
+                return False
+            self.answers[player_token] = normalise_answer(answer)
+            self.touched_at = time.time()
+            return True
+
+    def next(self):
+        """
+        Scores the current question and deals the next one, or ends the
+        game when the deck is exhausted. Returns the question sent, without
+        its answer: the host may be playing too.
+        """
+        with self._turn:
+            # the deck lookup runs outside the room lock, answers keep
+            # coming in meanwhile
+            question, cursor = decks.next_question(
+                self.category, self.seed, self.cursor, self.size)
+            with self._changed:
+                return self._deal(question, cursor)
+
+    def _deal(self, question, cursor):
+        if self.finished:
+            return None
+        if self.question is not None:
+            self._publish('results', self._results())
+        self.cursor = cursor
+        self.answers = {}
+        if question is None:
+            self.question = None
+            self.finished = True
+            self._publish('end', {'scores': self.scores})
+            return None
+        self.number += 1
+        self.question = question
+        dealt = without_answer(question)
+        self._publish('question', dict(dealt, number=self.number))
+        return dealt
+
+    def close(self):
+        """Ends the streams of an abandoned room."""
+        with self._changed:
+            self.finished = True
+            self._notify()
+
+    def _results(self):
+        expected = normalise_answer(self.question['answer'])
+        correct = []
+        for token, answer in self.answers.items():
+            name = self.players[token]
+            quiz_stats.record(self.question, answer == expected, name, 'room')
+            if answer == expected:
+                self.scores[name] += 1
+                correct.append(name)
+        return {
+            'number': self.number,
+            'question_id': self.question['id'],
+            'answer': self.question['answer'],
+            'answered': len(self.answers),
+            'correct': sorted(correct),
+            'scores': self.scores,
+        }
+
+    def _publish(self, event, data):
+        # called with the lock held
+        self._last_event += 1
+        self._events.append((self._last_event,
+                             format_event(self._last_event, event, data)))
+        del self._events[:-ROOM_EVENT_LOG]
+        self.touched_at = time.time()
+        self._notify()
+
+    def _notify(self):
+        # called with the lock held
+        self._changed.notify_all()
+        for loop, changed in self._waiters:
+            loop.call_soon_threadsafe(changed.set)
+
+    def _pending(self, last_event):
+        # called with the lock held
+        return [text for event_id, text in self._events if event_id > last_event]
+
+    def events(self, last_event=0, keepalive=ROOM_KEEPALIVE):
+        """
+        Yields the serialised events after `last_event`, waiting for new
+        ones, until the game has ended.
+        """
+        while True:
+            with self._changed:
+                pending = self._pending(last_event)
+                if not pending:
+                    if self.finished:
+                        return
+                    self._changed.wait(keepalive)
+                    pending = self._pending(last_event)
+                if pending:
+                    last_event = self._events[-1][0]
+            if pending:
+                yield ''.join(pending)
+            else:
+                # keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+
+    async def async_events(self, last_event=0, keepalive=ROOM_KEEPALIVE):
+        """events() for an event loop: waits without holding a thread."""
+        # only imported when served by asgi.py
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            changed = asyncio.Event()
+            waiter = (loop, changed)
+            with self._changed:
+                pending = self._pending(last_event)
+                if pending:
+                    last_event = self._events[-1][0]
+                elif self.finished:
+                    return
+                else:
+                    self._waiters.add(waiter)
+            if pending:
+                yield ''.join(pending)
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+            finally:
+                with self._changed:
+                    self._waiters.discard(waiter)
+
+
+"""
+RoomRegistry
+    the rooms of this process, by code; rooms untouched for `ttl` seconds
+    are dropped
+"""
+class RoomRegistry:
+
+    def __init__(self, ttl=ROOM_TTL):
+        self.ttl = ttl
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def create(self, category):
+        room = Room(category)
+        with self._lock:
+            self._evict_expired()
+            room.code = new_code()
+            while room.code in self._rooms:
+                room.code = new_code()
+            self._rooms[room.code] = room
+        return room
+
+    def get(self, code):
+        with self._lock:
+            self._evict_expired()
+            return self._rooms.get(code.upper())
+
+    def _evict_expired(self):
+        now = time.time()
+        for code in [code for code, room in self._rooms.items()
+                     if now - room.touched_at > self.ttl]:
+            self._rooms.pop(code).close()
+
+    def __len__(self):
+        return len(self._rooms)
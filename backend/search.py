@@ -0,0 +1,259 @@
+"""
+Question search
+
+Finds questions whose text contains the search term (case-insensitive),
+ranked with whole-word matches first, then by id, one page at a time.
+
+- PostgresSearch runs the ILIKE on the database, backed by a pg_trgm GIN
+  index (created by `flask init-db`) so the match doesn't need a sequential
+  scan.
+- MemorySearch keeps an in-process trigram inverted index over the question
+  text, kept up to date on Question.insert/update/delete. It is used when the
+  database isn't PostgreSQL or has no trigram index. With a question snapshot
+  (SNAPSHOT_PATH) it is built from, and its pages read from, the snapshot.
+"""
+
+import re
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import case
+
+from models import (db, Question, question_columns, format_question_row,
+                    on_question_change)
+from snapshot import snapshots
+
+
+SEARCH_INDEX_TTL = 5 * 60
+
+# pg_trgm GIN index serving ILIKE '%term%' on questions.question
+POSTGRES_SEARCH_INDEX = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_questions_question_trgm '
+    'ON questions USING gin (question gin_trgm_ops)',
+]
+
+
+def escape_like(term):
+    return (term.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def fetch_page(ids):
+    # load only the questions of one page, keeping the ranked order
+    snapshot = snapshots.current()
+    if snapshot is not None:
+        positions = (snapshot.find(question_id) for question_id in ids)
+        return [format_question_row(snapshot.row(position))
+                for position in positions if position is not None]
+    rows = (Question.query.with_entities(*question_columns)
+            .filter(Question.id.in_(ids)).all() if ids else [])
+    by_id = {row[0]: row for row in rows}
+    return [format_question_row(by_id[question_id]) for question_id in ids
+            if question_id in by_id]
+
+
+"""
+PostgresSearch
+    ranked ILIKE on the database, served by the pg_trgm index
+"""
+class PostgresSearch:
+
+    def warm(self):
+        # nothing held in process
+        pass
+
+    def search(self, term, page, per_page):
+        selection = Question.query.filter(
+            Question.question.ilike('%{}%'.format(escape_like(term)),
+                                    escape='\\'))
+        total = selection.count()
+        if page < 1:
+            return [], total
+
+        whole_word = Question.question.op('~*')(
+            r'\m{}\M'.format(re.escape(term)))
+        rows = (selection
+            .with_entities(*question_columns)
+            .order_by(case([(whole_word, 0)], else_=1), Question.id)
+            .offset((page - 1) * per_page)
+            .limit(per_page))
+
+        return [format_question_row(row) for row in rows], total
+
+
+"""
+MemorySearch
+    in-process trigram inverted index: trigram -> array of question ids.
+    Postings aren't pruned on update/delete; stale ids are dropped when the
+    candidate text is checked, and the index is rebuilt every `ttl` seconds
+    to pick up changes made by other workers.
+"""
+class MemorySearch:
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._texts = None
+        self._postings = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def _add(texts, postings, question_id, text):
+        text = (text or '').lower()
+        texts[question_id] = text
+        for gram in trigrams(text):
+            postings[gram].append(question_id)
+
+    def _load(self):
+        if self._texts is not None and time.time() < self._expires_at:
+            return
+        # while one thread rebuilds, the others keep using the old index
+        if not self._load_lock.acquire(blocking=self._texts is None):
+            return
+        try:
+            if self._texts is not None and time.time() < self._expires_at:
+                return
+            texts = {}
+            postings = defaultdict(lambda: array('i'))
+            snapshot = snapshots.current()
+            if snapshot is not None:
+                rows = ((snapshot.ids[position], snapshot.question_text(position))
+                        for position in snapshot.rows())
+            else:
+                rows = (Question.query
+                        .with_entities(Question.id, Question.question)
+                        .order_by(Question.id))
+            for question_id, text in rows:
+                self._add(texts, postings, question_id, text)
+            with self._lock:
+                self._texts, self._postings = texts, postings
+                self._expires_at = time.time() + self.ttl
+        finally:
+            self._load_lock.release()
+
+    def warm(self):
+        """Builds the index now rather than on the first search."""
+        self._load()
+
+    def question_changed(self, action, question):
+        with self._lock:
+            if self._texts is None:
+                return
+            if action == 'reset':
+                self._texts = None
+            elif action == 'delete':
+                self._texts.pop(question.id, None)
+            else:
+                self._add(self._texts, self._postings,
+                          question.id, question.question)
+
+    def matches(self, term):
+        """Ids of the questions containing `term`, ranked."""
+        term = term.lower()
+        while True:
+            self._load()
+            with self._lock:
+                # unless reset while we waited for the lock
+                if self._texts is not None:
+                    return self._matches(term)
+
+    def _matches(self, term):
+        texts = self._texts
+
+        grams = trigrams(term)
+        if grams:
+            # every match contains all trigrams of the term, so checking the
+            # rarest posting list is enough
+            postings = [self._postings.get(gram, ()) for gram in grams]
+            candidates = set(min(postings, key=len))
+        else:
+            # too short for trigrams
+            candidates = texts.keys()
+
+        whole_word = re.compile(r'\b{}\b'.format(re.escape(term)))
+        ranked = []
+        for question_id in candidates:
+            text = texts.get(question_id)
+            if text is not None and term in text:
+                rank = 0 if whole_word.search(text) else 1
+                ranked.append((rank, question_id))
+        ranked.sort()
+        return [question_id for _, question_id in ranked]
+
+    def search(self, term, page, per_page):
+        ids = self.matches(term)
+        if page < 1:
+            return [], len(ids)
+        start = (page - 1) * per_page
+        return fetch_page(ids[start:start + per_page]), len(ids)
+
+
+memory_search = MemorySearch()
+on_question_change(memory_search.question_changed)
+
+
+"""
+create_search_index()
+    creates the pg_trgm index, run once with `flask init-db`.
+    Returns False when the database isn't PostgreSQL.
+"""
+def create_search_index():
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    with db.engine.begin() as connection:
+        for statement in POSTGRES_SEARCH_INDEX:
+            connection.execute(statement)
+    return True
+
+
+def has_search_index():
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    with db.engine.connect() as connection:
+        return connection.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_questions_question_trgm'"
+        ).first() is not None
+
+
+"""
+AutoSearch
+    PostgresSearch when the trigram index exists, MemorySearch otherwise,
+    decided on the first search
+"""
+class AutoSearch:
+
+    def __init__(self):
+        self.backend = None
+
+    def _backend(self):
+        if self.backend is None:
+            self.backend = PostgresSearch() if has_search_index() else memory_search
+        return self.backend
+
+    def warm(self):
+        self._backend().warm()
+
+    def search(self, term, page, per_page):
+        return self._backend().search(term, page, per_page)
+
+
+"""
+make_search(backend)
+    'postgres', 'memory' or 'auto' (PostgreSQL when the trigram index exists)
+"""
+def make_search(backend='auto', ttl=SEARCH_INDEX_TTL):
+    memory_search.ttl = ttl
+    if backend == 'memory':
+        return memory_search
+    if backend == 'postgres':
+        return PostgresSearch()
+    return AutoSearch()
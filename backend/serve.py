@@ -0,0 +1,240 @@
+"""
+Pre-forking production server
+
+Builds the app once, warms the category map, question counters, quiz decks
+and in-memory search index in the parent, then forks the workers, which
+share the warm data copy-on-write and accept connections on the parent's
+listening socket. Each worker serves requests on threads (werkzeug's
+threaded server). With SNAPSHOT_PATH set, the question snapshot is
+rewritten first and the workers serve their reads from it.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--workers N]
+
+The worker count defaults to SERVE_WORKERS, or one per CPU core. The
+multiplayer rooms live in one process, so they are turned off (501) with
+more than one worker, and the ETag data version is shared through a file
+(HTTP_VERSION_PATH, see flaskr/http_cache.py).
+
+Signals to the parent:
+    HUP         reload the warm data and replace the workers gracefully:
+                new workers are forked before the old ones stop, and the
+                old ones finish their in-flight requests
+    TERM, INT   stop the workers gracefully and exit
+Workers that die are replaced.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+from flaskr import create_app
+from flaskr.http_cache import data_version
+from models import db, Category, notify_question_change
+from question_counts import question_counts
+from decks import decks
+from snapshot import snapshots
+from write_queue import write_queue
+from stats import quiz_stats
+
+
+"""
+warm(app)
+    loads everything the workers would otherwise load on their first
+    requests
+"""
+def warm(app):
+    with app.app_context():
+        # first, so the search index is built from it
+        if app.config['SNAPSHOT_PATH']:
+            snapshots.build()
+        Category.cache.get()
+        question_counts.total()
+        decks.warm()
+        app.extensions['question_search'].warm()
+
+
+"""
+before_fork(app)
+    stops the background threads create_app() started (write-behind and
+    stats flushers, deck reconciler, snapshot builder) and closes the
+    parent's database connections, so no worker is forked while one of them
+    holds a lock or inherits a pooled connection. run_worker() starts the
+    threads again in the worker.
+"""
+def before_fork(app):
+    write_queue.stop()
+    quiz_stats.stop()
+    decks.stop()
+    snapshots.wait()
+    with app.app_context():
+        dispose_engines(app)
+
+
+def reload_data(app):
+    with app.app_context():
+        Category.cache.invalidate()
+        notify_question_change('reset')
+    warm(app)
+
+
+def dispose_engines(app):
+    db.get_engine(app).dispose()
+    if app.config.get('DB_REPLICA_URL'):
+        db.get_engine(app, bind='replica').dispose()
+
+
+def run_worker(app, listener, host):
+    # workers mustn't deal the same quiz seeds
+    random.seed()
+    with app.app_context():
+        dispose_engines(app)
+    if app.config['WRITE_BEHIND']:
+        write_queue.start(app)
+    # the stats were rebuilt from the log in the parent, only the flusher
+    # thread is missing
+    quiz_stats.resume()
+    decks.start(app)
+
+    server = make_server(host, listener.getsockname()[1], app,
+                         threaded=True, fd=listener.fileno())
+    # server_close() then waits for the in-flight requests
+    server.daemon_threads = False
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    serving = threading.Thread(target=server.serve_forever)
+    serving.start()
+    while not stopping.wait(1):
+        pass
+    server.shutdown()
+    serving.join()
+    # commit what the flushers still hold
+    write_queue.stop()
+    quiz_stats.stop()
+
+
+class Arbiter:
+
+    def __init__(self, app, listener, host, workers):
+        self.app = app
+        self.listener = listener
+        self.host = host
+        self.size = workers
+        self.workers = set()
+        # old workers finishing their requests after a reload
+        self.retiring = set()
+        self.reload = False
+        self.stop = False
+
+    def spawn(self):
+        before_fork(self.app)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.listener, self.host)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers.add(pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.workers.discard(pid)
+            self.retiring.discard(pid)
+
+    def signal_all(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *args: setattr(self, 'reload', True))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: setattr(self, 'stop', True))
+
+        while not self.stop:
+            self.reap()
+            if self.reload:
+                self.reload = False
+                reload_data(self.app)
+                self.retiring |= self.workers
+                self.workers = set()
+                for _ in range(self.size):
+                    self.spawn()
+                self.signal_all(self.retiring, signal.SIGTERM)
+            while len(self.workers) < self.size:
+                self.spawn()
+            time.sleep(0.2)
+
+        self.signal_all(self.workers | self.retiring, signal.SIGTERM)
+        for pid in self.workers | self.retiring:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('SERVE_WORKERS', 0)) or os.cpu_count())
+    args = parser.parse_args()
+
+    app = create_app()
+    if args.workers > 1 and app.config['ROOMS']:
+        # a room's players would reach any of the workers
+        app.config['ROOMS'] = False
+        print('multiplayer rooms are off with {} workers, run one to serve '
+              'them'.format(args.workers), file=sys.stderr, flush=True)
+    shared = None
+    if args.workers > 1 and not app.config['HTTP_VERSION_PATH']:
+        # a change made in one worker changes the ETags of all of them
+        shared = tempfile.mkdtemp(prefix='trivia-')
+        app.config['HTTP_VERSION_PATH'] = os.path.join(shared, 'data-version')
+        data_version.start(app.config['HTTP_VERSION_PATH'])
+    warm(app)
+
+    listener = socket.socket(socket.AF_INET6 if ':' in args.host else socket.AF_INET)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(128)
+    # every worker wakes up for a new connection; the ones that lose the
+    # accept() race must get EAGAIN rather than block until the next one
+    listener.setblocking(False)
+    print('serving on http://{}:{} with {} workers'.format(
+        args.host, listener.getsockname()[1], args.workers), flush=True)
+
+    Arbiter(app, listener, args.host, args.workers).run()
+    listener.close()
+    if shared:
+        shutil.rmtree(shared, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
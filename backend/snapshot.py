@@ -0,0 +1,319 @@
+"""
+Question bank snapshot
+
+A read-only copy of the questions and categories tables in one file that
+workers mmap and serve reads from without a database round trip:
+
+    header      magic, format, question/category counts, string table size
+    ids         int32[n], ascending
+    category    int32[n]
+    difficulty  int32[n]
+    texts       int64[2n + 1], offsets of each question and answer in the
+                string table (question i is strings[texts[2i]:texts[2i+1]],
+                its answer strings[texts[2i+1]:texts[2i+2]])
+    by_category int32[m], row numbers grouped by category, ascending id
+    directory   int64[5c], per category: id, type start, type end and the
+                first and last+1 index of its rows in by_category
+    strings     utf-8
+
+Columns are memoryview casts over the mapping, so nothing is copied until a
+row is formatted. NULLs are stored as NULL_INT.
+
+The snapshot is written to a temporary file and renamed over the old one.
+Readers stat the file at most every CHECK_INTERVAL seconds and map the new
+one when it changed. After Question.insert/update/delete this process stops
+reading from its snapshot and rebuilds it in the background; other workers
+pick up the new file when it is renamed in. A failed rebuild is retried
+after REBUILD_RETRY seconds, doubling up to REBUILD_RETRY_MAX, and reads go
+to the database meanwhile.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from models import Question, Category, question_columns, on_question_change
+
+
+MAGIC = b'TRIVSNAP'
+FORMAT = 1
+HEADER = struct.Struct('<8sIIIIQ')
+NULL_INT = -2 ** 31
+CHECK_INTERVAL = 1
+REBUILD_RETRY = 1
+REBUILD_RETRY_MAX = 60
+
+
+def aligned(offset):
+    return (offset + 7) & ~7
+
+
+def section_offsets(n, m, c):
+    # start of each section, 8-byte aligned
+    offsets = {}
+    offset = HEADER.size
+    for name, size in (('ids', 4 * n), ('category', 4 * n),
+                       ('difficulty', 4 * n), ('texts', 8 * (2 * n + 1)),
+                       ('by_category', 4 * m), ('directory', 8 * 5 * c),
+                       ('strings', 0)):
+        offset = aligned(offset)
+        offsets[name] = offset
+        offset += size
+    return offsets
+
+
+"""
+build_snapshot(path)
+    writes the snapshot of the current tables to `path`, within an app
+    context. Returns the number of questions.
+"""
+def build_snapshot(path):
+    ids = array('i')
+    categories = array('i')
+    difficulties = array('i')
+    texts = array('q', [0])
+    strings = bytearray()
+
+    def add_string(value):
+        strings.extend((value or '').encode('utf-8'))
+        return len(strings)
+
+    rows = (Question.query.with_entities(*question_columns)
+            .order_by(Question.id).yield_per(1000))
+    grouped = {}
+    for question_id, question, answer, category, difficulty in rows:
+        position = len(ids)
+        ids.append(question_id)
+        categories.append(NULL_INT if category is None else int(category))
+        difficulties.append(NULL_INT if difficulty is None else difficulty)
+        texts.append(add_string(question))
+        texts.append(add_string(answer))
+        if category is not None:
+            grouped.setdefault(int(category), array('i')).append(position)
+
+    by_category = array('i')
+    directory = array('q')
+    for category in Category.query.order_by(Category.id):
+        type_start = len(strings)
+        type_end = add_string(category.type)
+        positions = grouped.get(category.id, array('i'))
+        directory.extend([category.id, type_start, type_end,
+                          len(by_category), len(by_category) + len(positions)])
+        by_category.extend(positions)
+
+    n, m, c = len(ids), len(by_category), len(directory) // 5
+    offsets = section_offsets(n, m, c)
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'wb') as output:
+        output.write(HEADER.pack(MAGIC, FORMAT, n, m, c, len(strings)))
+        for name, column in (('ids', ids), ('category', categories),
+                             ('difficulty', difficulties), ('texts', texts),
+                             ('by_category', by_category),
+                             ('directory', directory), ('strings', strings)):
+            output.write(b'\0' * (offsets[name] - output.tell()))
+            output.write(column if isinstance(column, bytearray)
+                         else column.tobytes())
+        output.flush()
+        os.fsync(output.fileno())
+    # readers see either the old file or the new one
+    os.replace(temporary, path)
+    return n
+
+
+"""
+Snapshot(path)
+    one mapped snapshot file
+"""
+class Snapshot:
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self.marker = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise ValueError('not a question snapshot: {}'.format(path))
+        magic, file_format, n, m, c, strings = HEADER.unpack_from(self._map)
+        offsets = section_offsets(n, m, c)
+        if (magic != MAGIC or file_format != FORMAT
+                or len(self._map) != offsets['strings'] + strings):
+            raise ValueError('not a question snapshot: {}'.format(path))
+
+        view = memoryview(self._map)
+
+        def column(name, count, code, size):
+            start = offsets[name]
+            return view[start:start + count * size].cast(code)
+
+        self.ids = column('ids', n, 'i', 4)
+        self._category = column('category', n, 'i', 4)
+        self._difficulty = column('difficulty', n, 'i', 4)
+        self._texts = column('texts', 2 * n + 1, 'q', 8)
+        self._by_category = column('by_category', m, 'i', 4)
+        directory = column('directory', 5 * c, 'q', 8)
+        self._strings = offsets['strings']
+
+        self.categories = {}
+        self._category_rows = {}
+        for index in range(c):
+            category, type_start, type_end, first, last = directory[5 * index:5 * index + 5]
+            self.categories[category] = self._string(type_start, type_end)
+            self._category_rows[category] = (first, last)
+
+    def _string(self, start, end):
+        return self._map[self._strings + start:self._strings + end].decode('utf-8')
+
+    def _int(self, column, position):
+        value = column[position]
+        return None if value == NULL_INT else value
+
+    def rows(self, category=None):
+        """Row numbers of a category (all rows when None), ascending id."""
+        if category is None:
+            return range(len(self.ids))
+        first, last = self._category_rows.get(category, (0, 0))
+        return self._by_category[first:last]
+
+    def after(self, rows, question_id):
+        """Index in `rows` of the first row with an id above `question_id`."""
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[rows[middle]] <= question_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, question_id):
+        """Row number of a question, None if it isn't in the snapshot."""
+        rows = self.rows()
+        position = self.after(rows, question_id) - 1
+        if position >= 0 and self.ids[position] == question_id:
+            return position
+        return None
+
+    def row(self, position):
+        """The question_columns tuple of a row."""
+        return (self.ids[position],
+                self._string(self._texts[2 * position], self._texts[2 * position + 1]),
+                self._string(self._texts[2 * position + 1], self._texts[2 * position + 2]),
+                self._int(self._category, position),
+                self._int(self._difficulty, position))
+
+    def question_text(self, position):
+        return self._string(self._texts[2 * position], self._texts[2 * position + 1])
+
+
+"""
+SnapshotStore
+    the current Snapshot of `path` for this process, None when snapshots
+    are off, not built yet or stale after a local change
+"""
+class SnapshotStore:
+
+    def __init__(self, path=None):
+        self.path = path
+        self._snapshot = None
+        self._checked_at = 0
+        self._stale = False
+        self._dirty = False
+        self._builder = None
+        self._app = None
+        self._lock = threading.Lock()
+        # cuts a retry delay short
+        self._wake = threading.Event()
+
+    def start(self, app, path):
+        """Serves `path`, building it in the background if missing."""
+        self._app = app
+        self.path = path
+        self._snapshot = None
+        self._checked_at = 0
+        self._stale = False
+        self._wake.set()
+        if path and not os.path.exists(path):
+            self.rebuild()
+
+    def current(self):
+        if not self.path or self._stale:
+            return None
+        if time.time() - self._checked_at >= CHECK_INTERVAL:
+            self._checked_at = time.time()
+            self._refresh()
+        return self._snapshot
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._snapshot = None
+            return
+        marker = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.marker != marker:
+            try:
+                # the old mapping is unmapped once no request uses it
+                self._snapshot = Snapshot(self.path)
+            except (OSError, ValueError):
+                self._snapshot = None
+
+    def question_changed(self, action, question=None):
+        if not self.path or self._app is None:
+            return
+        # our own change isn't in the file yet
+        self._stale = True
+        self.rebuild()
+
+    def rebuild(self):
+        with self._lock:
+            self._dirty = True
+            if self._builder is not None:
+                return
+            self._builder = threading.Thread(target=self._build, daemon=True,
+                                             name='question-snapshot')
+            self._builder.start()
+
+    def _build(self):
+        delay = REBUILD_RETRY
+        while True:
+            with self._lock:
+                if not self._dirty or not self.path:
+                    self._builder = None
+                    self._stale = False
+                    self._checked_at = 0
+                    return
+                self._dirty = False
+            try:
+                with self._app.app_context():
+                    build_snapshot(self.path)
+                delay = REBUILD_RETRY
+            except Exception as error:
+                # stays stale, the reads go to the database until it's built
+                self._app.logger.warning('question snapshot not built, retrying '
+                                         'in %ss: %s', delay, error)
+                self._wake.clear()
+                self._wake.wait(delay)
+                delay = min(delay * 2, REBUILD_RETRY_MAX)
+                with self._lock:
+                    self._dirty = True
+
+    def build(self):
+        """Rebuilds the snapshot now, within an app context."""
+        self.wait()
+        count = build_snapshot(self.path)
+        self._checked_at = 0
+        return count
+
+    def wait(self):
+        """Blocks until the pending rebuild (if any) has finished."""
+        builder = self._builder
+        if builder is not None:
+            builder.join()
+
+
+snapshots = SnapshotStore()
+on_question_change(snapshots.question_changed)
@@ -0,0 +1,201 @@
+"""
+Quiz statistics
+
+Every answered quiz question (single-player sessions, POST /stats/answers
+and multiplayer rooms) is recorded as one answer event. The aggregates
+served by GET /stats are updated in memory as events come in:
+
+- per question: times answered and answered correctly
+- per category and difficulty: the same counts, to check the difficulty
+  ratings against how often players actually get the questions right
+- a leaderboard of the `leaderboard_size` players with most correct answers
+
+With a log path, events are also appended to an NDJSON log, one line per
+event, by a background thread every `flush_interval` seconds rather than
+on every answer. The aggregates are rebuilt from the log at startup.
+Each worker process keeps its own aggregates: it sees the log as of its
+startup plus its own answers.
+"""
+
+import atexit
+import json
+import re
+import threading
+import time
+
+
+STATS_FLUSH_MS = 1000
+LEADERBOARD_SIZE = 10
+
+
+def normalise_answer(answer):
+    return re.sub(r'\s+', ' ', str(answer)).strip().casefold()
+
+
+def correct_answer(question, answer):
+    return normalise_answer(answer) == normalise_answer(question['answer'])
+
+
+def rate(answered, correct):
+    return round(correct / answered, 4) if answered else None
+
+
+class QuizStats:
+
+    def __init__(self, leaderboard_size=LEADERBOARD_SIZE):
+        self.leaderboard_size = leaderboard_size
+        self.path = None
+        self.flush_interval = STATS_FLUSH_MS / 1000
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flusher = None
+        self._stopping = threading.Event()
+        self._reset()
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self.total = 0
+        # question id -> [answered, correct]
+        self._questions = {}
+        # category -> difficulty -> [answered, correct]
+        self._categories = {}
+        # player -> correct answers, and the top of it as [player, score]
+        self._scores = {}
+        self._top = []
+
+    def start(self, path=None, flush_interval=STATS_FLUSH_MS / 1000):
+        """Rebuilds the aggregates from the log at `path` and logs to it."""
+        self.stop()
+        with self._lock:
+            self.path = path
+            self.flush_interval = flush_interval
+            self._pending = []
+            self._reset()
+            if path:
+                self._replay(path)
+        self.resume()
+
+    def resume(self):
+        """Starts the log flusher, again in a forked worker."""
+        if self.path and (self._flusher is None or not self._flusher.is_alive()):
+            self._stopping.clear()
+            self._flusher = threading.Thread(target=self._run, daemon=True,
+                                             name='quiz-stats')
+            self._flusher.start()
+
+    def stop(self):
+        """Flushes the log and stops the flusher."""
+        if self._flusher is not None:
+            self._stopping.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def _replay(self, path):
+        try:
+            lines = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with lines:
+            for line in lines:
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    # e.g. a line cut short by a crash
+                    continue
+
+    """
+    record(question, correct, player, source)
+        records one answer to `question` (a Question.format() dict)
+    """
+    def record(self, question, correct, player=None, source='quiz'):
+        event = {
+            'question_id': question['id'],
+            'category': question['category'],
+            'difficulty': question['difficulty'],
+            'correct': bool(correct),
+            'player': player,
+            'source': source,
+            'at': round(time.time(), 3),
+        }
+        with self._lock:
+            self._apply(event)
+            if self.path:
+                self._pending.append(event)
+
+    def _apply(self, event):
+        # called with the lock held
+        correct = 1 if event['correct'] else 0
+        self.total += 1
+        counts = self._questions.setdefault(event['question_id'], [0, 0])
+        counts[0] += 1
+        counts[1] += correct
+        by_difficulty = self._categories.setdefault(event['category'], {})
+        counts = by_difficulty.setdefault(event['difficulty'], [0, 0])
+        counts[0] += 1
+        counts[1] += correct
+        player = event.get('player')
+        if player and correct:
+            score = self._scores.get(player, 0) + 1
+            self._scores[player] = score
+            self._rank(player, score)
+
+    def _rank(self, player, score):
+        # scores only go up, so a player enters the top when they pass its
+        # last entry and nobody else's position needs recomputing
+        top = self._top
+        for entry in top:
+            if entry[0] == player:
+                entry[1] = score
+                break
+        else:
+            if len(top) < self.leaderboard_size or score > top[-1][1]:
+                top.append([player, score])
+        top.sort(key=lambda entry: (-entry[1], entry[0]))
+        del top[self.leaderboard_size:]
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Appends the pending events to the log."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            path = self.path
+        if not pending or not path:
+            return
+        # one write per batch, appended whole by every worker
+        with open(path, 'a', encoding='utf-8') as log:
+            log.write(''.join(json.dumps(event, separators=(',', ':')) + '\n'
+                              for event in pending))
+
+    def question(self, question_id):
+        with self._lock:
+            answered, correct = self._questions.get(question_id, (0, 0))
+        return {'question_id': question_id, 'answered': answered,
+                'correct_rate': rate(answered, correct)}
+
+    def summary(self, leaderboard_size=None):
+        """Totals, per-category calibration and the leaderboard."""
+        with self._lock:
+            categories = {}
+            for category, by_difficulty in self._categories.items():
+                answered = sum(counts[0] for counts in by_difficulty.values())
+                correct = sum(counts[1] for counts in by_difficulty.values())
+                categories[str(category)] = {
+                    'answered': answered,
+                    'correct_rate': rate(answered, correct),
+                    'difficulties': {
+                        str(difficulty): {'answered': counts[0],
+                                          'correct_rate': rate(*counts)}
+                        for difficulty, counts in by_difficulty.items()},
+                }
+            leaderboard = [{'player': player, 'score': score}
+                           for player, score in self._top[:leaderboard_size]]
+            return {'total_answers': self.total,
+                    'categories': categories,
+                    'leaderboard': leaderboard}
+
+
+quiz_stats = QuizStats()
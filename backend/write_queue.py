@@ -0,0 +1,281 @@
+"""
+Write-behind queue
+
+With WRITE_BEHIND on, question inserts and deletes don't commit in the
+request: the question gets its id right away and the write is queued, and a
+flusher thread commits the queued writes in batches of up to `batch_size`,
+at most `flush_interval` seconds after the first one was queued. Listeners
+(counters, decks, search, snapshot) are notified once a batch is committed,
+so a new question shows up in the listings after its batch is flushed.
+
+Ids come from the questions id sequence on PostgreSQL (nextval over
+generate_series, one round trip per block of ids). Elsewhere they come
+from an in-process counter above max(id), which is only safe with a single
+writing process.
+
+The queue holds at most `max_size` writes. When it is full, writers wait up
+to `put_timeout` seconds for the flusher to catch up and then get QueueFull.
+
+A question is queued for deletion once: delete() returns False while an
+earlier delete of it is pending, and listeners only hear of the deletes
+that removed a row.
+"""
+
+import queue
+import threading
+import time
+
+from sqlalchemy import func, select, text
+
+from models import (db, Question, question_columns, notify_question_change,
+                    on_question_change)
+
+
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_MS = 50
+WRITE_PUT_TIMEOUT = 5
+# ids reserved per sequence round trip
+ID_BLOCK = 50
+
+
+class QueueFull(Exception):
+    pass
+
+
+"""
+IdAllocator
+    hands out question ids before the rows are written
+"""
+class IdAllocator:
+
+    def __init__(self, block=ID_BLOCK):
+        self.block = block
+        self._ids = []
+        self._next = 1
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if db.engine.dialect.name == 'postgresql':
+                if not self._ids:
+                    self._ids = [row[0] for row in db.session.execute(
+                        text("SELECT nextval(pg_get_serial_sequence('questions', 'id')) "
+                             "FROM generate_series(1, :count)"),
+                        {'count': self.block})]
+                return self._ids.pop(0)
+            if self._stale:
+                # ids written behind our back (bulk imports) are skipped,
+                # the ones handed out already aren't reused
+                current = db.session.query(func.max(Question.id)).scalar() or 0
+                self._next = max(self._next, current + 1)
+                self._stale = False
+            question_id = self._next
+            self._next += 1
+            return question_id
+
+    def reset(self):
+        with self._lock:
+            self._stale = True
+
+
+class WriteQueue:
+
+    def __init__(self, max_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_MS / 1000,
+                 put_timeout=WRITE_PUT_TIMEOUT):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.ids = IdAllocator()
+        self._queue = None
+        self._flusher = None
+        self._app = None
+        # ids queued for deletion and not committed yet
+        self._deleting = set()
+        self._deleting_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = dict(queued=0, flushed=0, failed=0, batches=0,
+                           waits=0, rejected=0, flush_seconds=0.0,
+                           max_flush_seconds=0.0)
+
+    @property
+    def running(self):
+        return self._flusher is not None
+
+    def start(self, app):
+        """Starts the flusher thread of `app`'s writes."""
+        # a forked worker inherits the queue, not the thread
+        if self.running and self._flusher.is_alive():
+            self.stop()
+        self._app = app
+        self._queue = queue.Queue(self.max_size)
+        self._flusher = threading.Thread(target=self._run, daemon=True,
+                                         name='write-behind')
+        self._flusher.start()
+
+    def stop(self):
+        """Flushes the queue and stops the flusher."""
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._flusher.join()
+        self._flusher = None
+
+    def _put(self, write):
+        try:
+            self._queue.put_nowait(write)
+        except queue.Full:
+            self._count(waits=1)
+            try:
+                self._queue.put(write, timeout=self.put_timeout)
+            except queue.Full:
+                self._count(rejected=1)
+                raise QueueFull()
+        self._count(queued=1)
+
+    def insert(self, question):
+        """Assigns `question` its id and queues the insert."""
+        question.id = self.ids.allocate()
+        self._put(('insert', snapshot_question(question)))
+        return question.id
+
+    def delete(self, question):
+        """Queues the delete, False if `question` is queued for deletion already."""
+        with self._deleting_lock:
+            if question.id in self._deleting:
+                return False
+            self._deleting.add(question.id)
+        try:
+            self._put(('delete', snapshot_question(question)))
+        except QueueFull:
+            self._deleted([question.id])
+            raise
+        return True
+
+    def _deleted(self, ids):
+        with self._deleting_lock:
+            self._deleting.difference_update(ids)
+
+    def flush(self):
+        """Blocks until the writes queued so far are committed."""
+        if self.running:
+            self._queue.join()
+
+    def _run(self):
+        with self._app.app_context():
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]
+                deadline = time.time() + self.flush_interval
+                while len(batch) < self.batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(self._queue.get(
+                            timeout=max(deadline - time.time(), 0)))
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    stopping = True
+                writes = [write for write in batch if write is not None]
+                try:
+                    if writes:
+                        self._write(writes)
+                except Exception:
+                    # the flusher must outlive any batch, or flush() waits
+                    # forever and queued writes are lost
+                    self._app.logger.exception('write-behind batch of %d '
+                                               'writes failed', len(writes))
+                finally:
+                    db.session.remove()
+                    for _ in batch:
+                        self._queue.task_done()
+
+    def _write(self, writes):
+        started = time.time()
+        try:
+            deleted = self._commit(writes)
+            committed, failed = writes, []
+        except Exception as error:
+            self._app.logger.warning('write-behind batch failed, retrying '
+                                     'one by one: %s', error)
+            committed, failed, deleted = [], [], set()
+            for write in writes:
+                try:
+                    deleted |= self._commit([write])
+                    committed.append(write)
+                except Exception as error:
+                    self._app.logger.error('write-behind %s of question %s '
+                                           'dropped: %s', write[0], write[1].id, error)
+                    failed.append(write)
+        finally:
+            self._deleted([question.id for action, question in writes
+                           if action == 'delete'])
+        seconds = time.time() - started
+        with self._stats_lock:
+            stats = self._stats
+            stats['flushed'] += len(committed)
+            stats['failed'] += len(failed)
+            stats['batches'] += 1
+            stats['flush_seconds'] += seconds
+            stats['max_flush_seconds'] = max(stats['max_flush_seconds'], seconds)
+        for action, question in committed:
+            if action == 'delete' and question.id not in deleted:
+                # gone before this delete ran
+                continue
+            notify_question_change(action, question)
+
+    def _commit(self, writes):
+        """Commits `writes`, returns the ids of the rows deleted."""
+        # inserts first, a batch may delete a question it inserts
+        table = Question.__table__
+        rows = [question_row(question) for action, question in writes
+                if action == 'insert']
+        ids = [question.id for action, question in writes if action == 'delete']
+        deleted = set()
+        try:
+            if rows:
+                db.session.execute(table.insert(), rows)
+            if ids:
+                # locked, so a concurrent delete can't remove them in between
+                deleted = {row[0] for row in db.session.execute(
+                    select([table.c.id]).where(table.c.id.in_(ids)).with_for_update())}
+                if deleted:
+                    db.session.execute(table.delete().where(table.c.id.in_(deleted)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return deleted
+
+    def question_changed(self, action, question=None):
+        if action == 'reset':
+            self.ids.reset()
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+
+def snapshot_question(question):
+    # a detached copy for the flusher thread and the listeners
+    copy = Question(question.question, question.answer,
+                    question.category, question.difficulty)
+    copy.id = question.id
+    return copy
+
+
+def question_row(question):
+    return {column.key: getattr(question, column.key) for column in question_columns}
+
+
+write_queue = WriteQueue()
+on_question_change(write_queue.question_changed)
@@ -10,6 +10,7 @@ class QuizView extends Component {
     this.state = {
       quizCategory: null,
       previousQuestions: [],
+      upcomingQuestions: [],
       showAnswer: false,
       categories: {},
       numCorrect: 0,
@@ -35,49 +36,60 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState({ quizCategory: { type, id } }, this.getQuestions);
   };
 
   handleChange = (event) => {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
-
+  // the whole game is fetched in one request, then played locally
+  getQuestions = () => {
     $.ajax({
-      url: '/quizzes', //TODO: update request URL
+      url: '/quizzes/batch', //TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
       data: JSON.stringify({
-        previous_questions: previousQuestions,
+        previous_questions: this.state.previousQuestions,
         quiz_category: this.state.quizCategory,
+        count: questionsPerPlay,
       }),
       xhrFields: {
         withCredentials: true,
       },
       crossDomain: true,
       success: (result) => {
-        this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: '',
-          forceEnd: result.question ? false : true,
-        });
+        this.setState(
+          { upcomingQuestions: result.questions },
+          this.getNextQuestion
+        );
         return;
       },
       error: (error) => {
-        alert('Unable to load question. Please try your request again');
+        alert('Unable to load questions. Please try your request again');
         return;
       },
     });
   };
 
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions];
+    if (this.state.currentQuestion.id) {
+      previousQuestions.push(this.state.currentQuestion.id);
+    }
+    const [nextQuestion, ...upcomingQuestions] = this.state.upcomingQuestions;
+
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      upcomingQuestions: upcomingQuestions,
+      currentQuestion: nextQuestion || {},
+      guess: '',
+      forceEnd: nextQuestion ? false : true,
+    });
+  };
+
   submitGuess = (event) => {
     event.preventDefault();
     let evaluate = this.evaluateAnswer();
@@ -91,6 +103,7 @@ class QuizView extends Component {
     this.setState({
       quizCategory: null,
       previousQuestions: [],
+      upcomingQuestions: [],
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},